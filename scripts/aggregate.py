@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Per minute, hour or day statistics of session data.
+
+Reads session files (csv "TimeStamp,Value" or binary ".tcb" directories)
+into numpy arrays and computes count, mean, min, max, standard deviation
+and percentiles per bucket, grouped by calendar time so the same hour of
+two different days never merges.
+
+    scripts/aggregate.py data/sessions/ESP1_dht11/onchange_200101120000.csv
+    scripts/aggregate.py on_change_data.csv --ts-col 0 --group-col 2 --value-col 3 -b day
+
+The second form reads multi-sensor files like the old data_per_hour.py input.
+"""
+from time import localtime
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+
+BUCKETS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+TS_FORMAT = {
+    "minute": '%Y-%m-%d %H:%M',
+    "hour": '%Y-%m-%d %H:00',
+    "day": '%Y-%m-%d'
+}
+RECORD_DTYPE = [('ts', '<i8'), ('value', '<i4')]
+
+
+def load_csv(fp: str, ts_col=0, value_col=1, group_col=None):
+    """Returns (naive local seconds, values, groups or None) of a csv file.
+    Every column is parsed in bulk, there is no per-row Python code."""
+    with open(fp, 'r') as f:
+        first = f.readline()
+    skip = 0 if first[:1].isdigit() else 1
+
+    cols = [ts_col, value_col]
+    dtype = [('ts', 'datetime64[s]'), ('value', np.float64)]
+    if group_col is not None:
+        cols.append(group_col)
+        dtype.append(('group', 'U32'))
+    data = np.loadtxt(fp, delimiter=',', dtype=dtype, skiprows=skip,
+        usecols=cols, ndmin=1, comments=None)
+    ts = data['ts'].astype('<i8')
+    values = data['value']
+    groups = np.char.strip(data['group']) if group_col is not None else None
+    return ts, values, groups
+
+
+def load_bin(path: str):
+    """Returns (naive local seconds, values, None) of a binary session"""
+    segments = sorted(f for f in os.listdir(path) if f.endswith('.seg'))
+    arr = np.concatenate([np.fromfile(f"{path}/{f}", dtype=RECORD_DTYPE) for f in segments]) \
+        if segments else np.empty(0, dtype=RECORD_DTYPE)
+    epoch = arr['ts']
+    # local time offset resolved once per distinct hour
+    hours, inverse = np.unique(epoch // 3600, return_inverse=True)
+    offsets = np.array([localtime(h * 3600).tm_gmtoff for h in hours.tolist()], dtype='<i8')
+    return epoch + offsets[inverse.reshape(-1)], arr['value'].astype(np.float64), None
+
+
+def aggregate(ts, values, bucket='hour', percentiles=(50, 90, 99)) -> dict:
+    """Statistics per bucket of naive local seconds, as numpy arrays.
+
+    Rows are sorted by (bucket, value) once; every statistic is then a
+    reduceat over the group boundaries or an index into the sorted values.
+    """
+    width = BUCKETS[bucket]
+    keys = ts // width
+    order = np.lexsort((values, keys))
+    keys = keys[order]
+    v = values[order]
+
+    if not len(v):
+        empty = np.empty(0)
+        res = {"bucket": empty.astype('<i8'), "count": empty.astype('<i8'), "mean": empty,
+            "min": empty, "max": empty, "std": empty}
+        res.update({f"p{q:g}": empty for q in percentiles})
+        return res
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(v)])
+    ends = starts + counts - 1
+
+    mean = np.add.reduceat(v, starts) / counts
+    dev = v - np.repeat(mean, counts)
+    std = np.sqrt(np.add.reduceat(dev * dev, starts) / counts)
+
+    res = {
+        "bucket": keys[starts] * width,
+        "count": counts,
+        "mean": mean,
+        "min": v[starts],
+        "max": v[ends],
+        "std": std
+    }
+    for q in percentiles:
+        pos = starts + (counts - 1) * (q / 100)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, ends)
+        res[f"p{q:g}"] = v[lo] + (v[hi] - v[lo]) * (pos - lo)
+    return res
+
+
+def rows(stats: dict, bucket: str, group=None) -> list:
+    """Printable rows, bucket start formatted in local time"""
+    labels = stats['bucket'].astype('datetime64[s]').astype(object)
+    fmt = TS_FORMAT[bucket]
+    cols = [k for k in stats if k != 'bucket']
+    out = []
+    for i, label in enumerate(labels):
+        row = {"group": group} if group is not None else {}
+        row[bucket] = label.strftime(fmt)
+        for k in cols:
+            x = stats[k][i]
+            row[k] = int(x) if k == 'count' else round(float(x), 3)
+        out.append(row)
+    return out
+
+
+def main():
+    aparser = argparse.ArgumentParser("aggregate", description=__doc__.split('\n')[0])
+    aparser.add_argument('files', nargs='+', help="csv session files or .tcb session directories")
+    aparser.add_argument('-b', '--bucket', choices=list(BUCKETS), default='hour')
+    aparser.add_argument('-p', '--percentiles', nargs='*', type=float, default=[50, 90, 99])
+    aparser.add_argument('-f', '--format', choices=['table', 'csv', 'json'], default='table')
+    aparser.add_argument('--ts-col', type=int, default=0)
+    aparser.add_argument('--value-col', type=int, default=1)
+    aparser.add_argument('--group-col', type=int, default=None,
+        help="column splitting one file into series, e.g. the sensor type")
+    args = aparser.parse_args()
+
+    out = []
+    for fp in args.files:
+        if os.path.isdir(fp):
+            ts, values, groups = load_bin(fp)
+        else:
+            ts, values, groups = load_csv(fp, args.ts_col, args.value_col, args.group_col)
+
+        if groups is None:
+            series = [(fp if len(args.files) > 1 else None, ts, values)]
+        else:
+            series = [(g, ts[groups == g], values[groups == g]) for g in np.unique(groups)]
+
+        for group, t, v in series:
+            stats = aggregate(t, v, args.bucket, args.percentiles)
+            out += rows(stats, args.bucket, group)
+
+    if args.format == 'json':
+        json.dump(out, sys.stdout, indent=2)
+        print()
+    elif out:
+        keys = list(out[0])
+        sep = ',' if args.format == 'csv' else '\t'
+        print(sep.join(keys))
+        for row in out:
+            print(sep.join(str(row[k]) for k in keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Per-message cost of the board websocket path of tc_service.
+
+Runs WebsocketDataListener.on_message on a detached handler (no socket)
+for text frames, malformed frames and binary batches, then the ingest
+consumer's _process over the queued frames with an onchange session on
+each sensor, and reports microseconds per value.
+
+    scripts/bench_on_message.py
+    scripts/bench_on_message.py -n 200000 --sensors 4 --batch 64 -f json
+
+The service's data directory is a temporary directory (HOME is pointed at
+it before importing), nothing is written to the repository. "legacy" is
+the text path before the per-connection dispatch table, for comparison.
+"""
+from time import perf_counter, time
+
+import os
+import sys
+import json
+import struct
+import tempfile
+import argparse
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_service(tmp: str):
+    """Imports tc_service with its data directory in tmp"""
+    os.environ['HOME'] = tmp
+    os.environ['TC_INGEST_POLICY'] = 'drop'  # never wait on a full queue
+    os.environ['TC_INGEST_QUEUE'] = str(1 << 30)
+    sys.argv = [sys.argv[0]]
+    sys.path.insert(0, BASE_DIR)
+    import tc_service
+    return tc_service
+
+
+def legacy_on_message(tc, handler, message):
+    """The text path before the dispatch table"""
+    t0 = perf_counter()
+    if tc.TRACE:
+        tc.log("message", message, board=handler.id)
+    data = message.split(':')
+    sen = data[0]
+    ivalue = int(data[1])
+    tc.BOARD_MESSAGES.inc((handler.id, sen))
+    res = tc.Ingest.put(handler.id, ((sen, ((time(), ivalue),)),))
+    tc.ON_MESSAGE.observe(perf_counter() - t0)
+    return res
+
+
+def timed(fn, frames: list, values_per_frame: int, drain, repeat: int) -> dict:
+    """Runs fn over frames, draining the ingest queue outside the timing.
+    The fastest of `repeat` runs is kept, the others mostly measure noise."""
+    best = None
+    for _ in range(repeat):
+        total = 0.0
+        for i in range(0, len(frames), 1000):
+            chunk = frames[i:i + 1000]
+            t0 = perf_counter()
+            for frame in chunk:
+                fn(frame)
+            total += perf_counter() - t0
+            drain()
+        best = total if best is None else min(best, total)
+    total = best
+    n = len(frames) * values_per_frame
+    return {"values": n, "us_per_value": round(total * 1e6 / n, 3),
+        "values_per_s": int(n / total) if total else 0}
+
+
+def main():
+    aparser = argparse.ArgumentParser("bench_on_message", description=__doc__.split('\n')[0])
+    aparser.add_argument('-n', '--messages', type=int, default=100000)
+    aparser.add_argument('--sensors', type=int, default=2, help="sensors of the board")
+    aparser.add_argument('--batch', type=int, default=32, help="samples per binary frame")
+    aparser.add_argument('-r', '--repeat', type=int, default=5, help="runs per path, the fastest is kept")
+    aparser.add_argument('-f', '--format', choices=['table', 'json'], default='table')
+    args = aparser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="tc-bench-")
+    tc = load_service(tmp)
+    from tornado.ioloop import IOLoop
+
+    os.makedirs(tc.SESS_DIR, exist_ok=True)
+    os.makedirs(tc.WAL_DIR, exist_ok=True)
+    names = [f"s{i}" for i in range(args.sensors)]
+    board = tc.Board('bench', '127.0.0.1', tc.time_stamp())
+    for name in names:
+        board.new_sensor(name, 'Temperature', 'Celsius')
+    tc.BOARDS[board.id] = board
+
+    handler = tc.WebsocketDataListener.__new__(tc.WebsocketDataListener)
+    handler.id = board.id
+    handler.bad_frames = 0
+    handler.bind(board, names)
+
+    async def setup():
+        tc.Ingest.start()
+        for name in names:
+            session = await board.new_session(name, 'onchange', stype='open')
+            await session.start()
+    IOLoop.current().run_sync(setup)
+
+    def drain():
+        tc.Ingest._queue.clear()
+
+    text = [f"{names[i % len(names)]}:{i % 1000}" for i in range(args.messages)]
+    bad = [("x" if i % 2 else f"{names[0]}:1O") for i in range(args.messages)]
+    samples = [(i % len(names), i, i % 1000) for i in range(args.batch)]
+    batch = struct.pack('<Q', 0) + b''.join(tc.BATCH_SAMPLE.pack(*s) for s in samples)
+    batches = [batch] * max(1, args.messages // args.batch)
+
+    results = {}
+    r = args.repeat
+    results['legacy'] = timed(lambda m: legacy_on_message(tc, handler, m), text, 1, drain, r)
+    results['text'] = timed(handler.on_message, text, 1, drain, r)
+    handler.bad_frames = 0
+    results['malformed'] = timed(handler.on_message, bad, 1, drain, 1)
+    results['binary'] = timed(handler.on_message, batches, args.batch, drain, r)
+
+    # the consumer side: write-ahead log, storage buffers, alert rules and hub, per value
+    for message in text:
+        handler.on_message(message)
+    text_frames = list(tc.Ingest._queue)
+    drain()
+    rounds = [text_frames[i:i + tc.INGEST_BATCH] for i in range(0, len(text_frames), tc.INGEST_BATCH)]
+    t0 = perf_counter()
+    for frames in rounds:
+        tc.Ingest._process(frames)
+    total = perf_counter() - t0
+    tc.SessionWriter._buffers.clear()
+    results['process'] = {"values": len(text_frames),
+        "us_per_value": round(total * 1e6 / len(text_frames), 3),
+        "values_per_s": int(len(text_frames) / total) if total else 0}
+    results['malformed']['rejected'] = handler.bad_frames
+
+    if args.format == 'json':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print("path\tvalues\tus/value\tvalues/s")
+        for path, r in results.items():
+            print(f"{path}\t{r['values']}\t{r['us_per_value']}\t{r['values_per_s']}")
+
+
+if __name__ == '__main__':
+    main()
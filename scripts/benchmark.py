@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""Ingest load generator and benchmark for tc_service.
+
+Simulates boards on /ws/board sending the sketches' "sensor:value" frames
+(or binary batches with --proto bin), a board /data endpoint polled by
+interval sessions and client dashboards on /ws/client, then reports
+throughput, end-to-end latency and the service's CPU and memory.
+
+    scripts/benchmark.py -b 50 -r 20 -c 4 -t 30
+    scripts/benchmark.py -b 200 -r 5 --proto bin --interval-boards 20 -f json
+
+Every value a board sends is a per-sensor sequence number, so frames seen by
+the clients and rows found in the session files are matched back to their
+send time. Disk latency needs the service's data directory on this host
+(--data-dir) and includes the writer's flush interval. Boards are named
+bench-N; their sessions are finished with the clear option at the end
+unless --keep is given.
+"""
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
+from tornado.websocket import websocket_connect
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import url_concat
+from tornado import gen
+from time import time, perf_counter
+
+import os
+import sys
+import json
+import struct
+import argparse
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_HEADER = struct.Struct('<Q')
+BATCH_SAMPLE = struct.Struct('<BHi')
+RECORD = struct.Struct('<qi')
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q / 100))], 3)
+
+
+def latency(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p99_ms": percentile(values, 99),
+        "max_ms": round(max(values), 3) if values else 0.0
+    }
+
+
+class FakeBoard(RequestHandler):
+    """/data of every simulated board, answers "sensor:seq" """
+
+    def get(self, path=None):
+        bench = self.settings['bench']
+        if path == '/config':
+            return
+        sensor = self.get_argument('sensor')
+        bench.polls += 1
+        self.write(f"{sensor}:{bench.polls}")
+
+
+class ProcStats:
+    """CPU and RSS of the service processes, from /proc"""
+
+    def __init__(self, pids: list):
+        self.pids = pids
+        self.samples = []
+        self._last = None
+
+    @staticmethod
+    def find() -> list:
+        pids = []
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                    cmd = f.read()
+            except OSError:
+                continue
+            if b'tc_service.py' in cmd and b'benchmark' not in cmd:
+                pids.append(int(pid))
+        return pids
+
+    def _read(self) -> tuple:
+        ticks = rss = 0
+        for pid in self.pids:
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1]) * 1024
+            except OSError:
+                continue
+        return perf_counter(), ticks, rss
+
+    def sample(self) -> None:
+        now, ticks, rss = self._read()
+        if self._last:
+            t, last_ticks = self._last
+            self.samples.append((100 * (ticks - last_ticks) / CLK_TCK / (now - t), rss))
+        self._last = (now, ticks)
+
+    def report(self) -> dict:
+        cpu = [c for c, _ in self.samples]
+        rss = [r for _, r in self.samples]
+        return {
+            "pids": self.pids,
+            "cpu_avg_pct": round(sum(cpu) / len(cpu), 1) if cpu else 0.0,
+            "cpu_max_pct": round(max(cpu), 1) if cpu else 0.0,
+            "rss_max_mb": round(max(rss) / 2 ** 20, 1) if rss else 0.0
+        }
+
+
+class Benchmark:
+
+    def __init__(self, args):
+        self.args = args
+        self.http = args.url.replace('ws://', 'http://')
+        self.boards = [f"bench-{i}" for i in range(args.boards)]
+        self.sensors = [f"s{i}" for i in range(args.sensors)]
+        self.sent = {}        # (board, sensor, seq) -> perf_counter at send
+        self.sent_count = 0
+        self.client_ms = []
+        self.client_frames = 0
+        self.disk_ms = []
+        self.tails = {}       # (board, sensor) -> [path, position]
+        self.polls = 0
+        self.running = True
+        self.proc = ProcStats(args.pid or ProcStats.find())
+        self._sampler = None
+        self._disk = None
+
+    # Clients
+
+    async def client(self) -> None:
+        ws = await websocket_connect(self.args.url + '/ws/client')
+        await ws.read_message()
+        while True:
+            msg = await ws.read_message()
+            if msg is None:
+                return
+            now = perf_counter()
+            self.client_frames += 1
+            frame = json.loads(msg)
+            if frame['type'] == 'value':
+                points = [(frame['board'], frame['sensor'], frame['value'])]
+            elif frame['type'] == 'values':
+                points = [(s['board'], s['sensor'], v) for s in frame['series'] for _, v in s['points']]
+            else:
+                continue
+            for key in points:
+                sent = self.sent.get(key)
+                if sent is not None:
+                    self.client_ms.append((now - sent) * 1000)
+
+    # Boards
+
+    async def connect(self, board: str):
+        params = {"id": board, "sens": ':'.join(self.sensors), "port": self.args.fake_port,
+            "proto": self.args.proto}
+        params.update({s: "Temperature:Celsius" for s in self.sensors})
+        ws = await websocket_connect(url_concat(self.args.url + '/ws/board', params))
+        order = self.sensors
+        if self.args.proto == 'bin':
+            order = json.loads(await ws.read_message())['sensors']
+        return ws, {s: i for i, s in enumerate(order)}
+
+    async def board(self, board: str, ws, index: dict) -> None:
+        """Sends every sensor at --rate values per second until stopped"""
+        args = self.args
+        batch = args.batch if args.proto == 'bin' else 1
+        step = batch / args.rate
+        seq = 0
+        start = perf_counter()
+        tick = 0
+        while self.running:
+            tick += 1
+            delay = start + tick * step - perf_counter()
+            if delay > 0:
+                await gen.sleep(delay)
+            now = perf_counter()
+            if args.proto == 'bin':
+                samples = []
+                for i in range(batch):
+                    seq += 1
+                    for s in self.sensors:
+                        self.sent[(board, s, seq)] = now
+                        samples.append(BATCH_SAMPLE.pack(index[s], i, seq))
+                ws.write_message(BATCH_HEADER.pack(int(time() * 1000)) + b''.join(samples), binary=True)
+                self.sent_count += batch * len(self.sensors)
+            else:
+                seq += 1
+                for s in self.sensors:
+                    self.sent[(board, s, seq)] = now
+                    ws.write_message(f"{s}:{seq}")
+                self.sent_count += len(self.sensors)
+
+    # Sessions
+
+    async def new_session(self, board: str, sensor: str, description: str) -> None:
+        body = {
+            "board": board,
+            "sensor": sensor,
+            "session": {
+                "type": "open",
+                "description": description,
+                "interval_type": "second" if description == 'interval' else False,
+                "interval": 1 if description == 'interval' else False,
+                "start_date": False,
+                "finish_date": False,
+                "alert": False,
+                "min_value": False,
+                "max_value": False
+            }
+        }
+        await AsyncHTTPClient().fetch(self.http + '/session', method='POST',
+            body=json.dumps(body), raise_error=False)
+
+    async def clear_sessions(self) -> None:
+        for board in self.boards:
+            res = await AsyncHTTPClient().fetch(url_concat(self.http + '/session', {"board": board}),
+                raise_error=False)
+            if res.code != 200:
+                continue
+            for sid in json.loads(res.body)['sessions']['active']:
+                await AsyncHTTPClient().fetch(url_concat(self.http + '/session/action/finish',
+                    {"board": board, "session": sid, "option": "clear"}), raise_error=False)
+
+    # Disk
+
+    def _find(self, board: str, sensor: str):
+        folder = f"{self.args.data_dir}/sessions/{board}_{sensor}"
+        try:
+            names = sorted(f for f in os.listdir(folder) if f.startswith('onchange_')
+                and (f.endswith('.csv') or f.endswith('.tcb')))
+        except OSError:
+            return None
+        return f"{folder}/{names[-1]}" if names else None
+
+    def _tail(self, key: tuple, tail: list) -> list:
+        """New values in a session file since the last call"""
+        path, pos = tail
+        values = []
+        if path.endswith('.csv'):
+            with open(path, 'rb') as f:
+                f.seek(pos)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            tail[1] = pos + end
+            for line in data[:end].splitlines():
+                ts, _, value = line.rpartition(b',')
+                if ts[:1].isdigit():
+                    values.append(int(value))
+        else:
+            segments = sorted(f for f in os.listdir(path) if f.endswith('.seg'))
+            # position counts records over all segments
+            done = 0
+            for seg in segments:
+                size = os.path.getsize(f"{path}/{seg}") // RECORD.size
+                if done + size > pos:
+                    with open(f"{path}/{seg}", 'rb') as f:
+                        f.seek((pos - done) * RECORD.size)
+                        data = f.read((done + size - pos) * RECORD.size)
+                    values.extend(v for _, v in RECORD.iter_unpack(data))
+                    pos = done + size
+                done += size
+            tail[1] = pos
+        return values
+
+    def poll_disk(self) -> None:
+        now = perf_counter()
+        for board in self.boards:
+            for sensor in self.sensors:
+                key = (board, sensor)
+                tail = self.tails.get(key)
+                if tail is None:
+                    path = self._find(board, sensor)
+                    if path is None:
+                        continue
+                    tail = self.tails[key] = [path, 0]
+                try:
+                    values = self._tail(key, tail)
+                except OSError:
+                    continue
+                for value in values:
+                    sent = self.sent.get((board, sensor, value))
+                    if sent is not None:
+                        self.disk_ms.append((now - sent) * 1000)
+
+    # Run
+
+    async def run(self) -> dict:
+        args = self.args
+        app = Application([(r"/data(/config)?", FakeBoard)], bench=self)
+        app.listen(args.fake_port, '127.0.0.1')
+
+        for _ in range(args.clients):
+            IOLoop.current().spawn_callback(self.client)
+
+        connections = {}
+        for board in self.boards:
+            connections[board] = await self.connect(board)
+        await gen.sleep(0.5)
+        for board in self.boards:
+            for sensor in self.sensors:
+                await self.new_session(board, sensor, 'onchange')
+        for board in self.boards[:args.interval_boards]:
+            await self.new_session(board, self.sensors[0], 'interval')
+        await gen.sleep(1)
+
+        if self.proc.pids:
+            self._sample()
+        if os.path.isdir(args.data_dir):
+            self._poll_disk()
+
+        polls = self.polls
+        start = perf_counter()
+        for board, (ws, index) in connections.items():
+            IOLoop.current().spawn_callback(self.board, board, ws, index)
+        await gen.sleep(args.duration)
+        self.running = False
+        elapsed = perf_counter() - start
+        polled = self.polls - polls
+        await gen.sleep(args.drain)
+
+        for timer in (self._sampler, self._disk):
+            if timer:
+                IOLoop.current().remove_timeout(timer)
+        self.poll_disk()
+
+        res = await AsyncHTTPClient().fetch(self.http + '/', raise_error=False)
+        service = json.loads(res.body) if res.code == 200 else {}
+
+        if not args.keep:
+            await self.clear_sessions()
+        for ws, _ in connections.values():
+            ws.close()
+
+        expected = self.sent_count * args.clients
+        return {
+            "boards": args.boards,
+            "sensors": args.sensors,
+            "proto": args.proto,
+            "clients": args.clients,
+            "duration_s": round(elapsed, 3),
+            "sent": self.sent_count,
+            "sent_per_s": round(self.sent_count / elapsed, 1),
+            "client_received": len(self.client_ms),
+            "client_lost": max(0, expected - len(self.client_ms)),
+            "client_frames": self.client_frames,
+            "client_latency": latency(self.client_ms),
+            "disk_rows": len(self.disk_ms),
+            "disk_latency": latency(self.disk_ms),
+            "polls_per_s": round(polled / elapsed, 2),
+            "polls_expected_per_s": min(args.interval_boards, args.boards),
+            "process": self.proc.report(),
+            "service": {k: service.get(k) for k in ("writer", "ingest", "hub", "scheduler")}
+        }
+
+    def _sample(self) -> None:
+        self.proc.sample()
+        self._sampler = IOLoop.current().call_later(1, self._sample)
+
+    def _poll_disk(self) -> None:
+        self.poll_disk()
+        self._disk = IOLoop.current().call_later(self.args.disk_poll, self._poll_disk)
+
+
+def print_table(report: dict, prefix='') -> None:
+    for k, v in report.items():
+        if isinstance(v, dict):
+            print_table(v, f"{prefix}{k}.")
+        else:
+            print(f"{prefix}{k}\t{v}")
+
+
+def main():
+    aparser = argparse.ArgumentParser("benchmark", description=__doc__.split('\n')[0])
+    aparser.add_argument('-u', '--url', default='ws://localhost:8000')
+    aparser.add_argument('-b', '--boards', type=int, default=10)
+    aparser.add_argument('-s', '--sensors', type=int, default=2, help="sensors per board")
+    aparser.add_argument('-r', '--rate', type=float, default=10, help="values per second and sensor")
+    aparser.add_argument('-c', '--clients', type=int, default=1, help="dashboards on /ws/client")
+    aparser.add_argument('-t', '--duration', type=float, default=10, help="seconds")
+    aparser.add_argument('--drain', type=float, default=3, help="seconds to wait for stragglers")
+    aparser.add_argument('--proto', choices=['text', 'bin'], default='text')
+    aparser.add_argument('--batch', type=int, default=10, help="samples per sensor and binary frame")
+    aparser.add_argument('--interval-boards', type=int, default=0,
+        help="boards with a one second interval session, polled on --fake-port")
+    aparser.add_argument('--fake-port', type=int, default=8090)
+    aparser.add_argument('--data-dir', default=f"{BASE_DIR}/data", help="service data directory")
+    aparser.add_argument('--disk-poll', type=float, default=0.1, help="seconds between file checks")
+    aparser.add_argument('--pid', type=int, nargs='*', help="service pids, found in /proc by default")
+    aparser.add_argument('--keep', action='store_true', help="leave the sessions running")
+    aparser.add_argument('-f', '--format', choices=['table', 'json'], default='table')
+    args = aparser.parse_args()
+
+    report = IOLoop.current().run_sync(Benchmark(args).run)
+    if args.format == 'json':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
 #!/bin/bash
 SCRIPTPATH=$(dirname $(dirname $(realpath -s $0)))
 git pull
-sleep 3
+# start as soon as the stopped server has released its port, 3s at most
+PORT=${TC_PORT:-8000}
+for i in $(seq 60); do
+    (exec 3<>/dev/tcp/127.0.0.1/$PORT) 2>/dev/null || break
+    sleep 0.05
+done
 cd $SCRIPTPATH
 nohup python3 "$SCRIPTPATH/tc_service.py" &
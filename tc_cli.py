@@ -4,15 +4,14 @@
 # Config server
 # Get data 
 # Show data with filters
-# Show logs
 # Gen csv with Simple data
-from datetime import datetime
-
+# requests, csv and subprocess are imported by the commands using them, so
+# init, --help and argument errors start fast; batch runs many commands in
+# one process over one pooled HTTP session.
 import sys
 import os
-import requests
-import csv
 import json
+import shlex
 import argparse
 
 
@@ -22,6 +21,9 @@ DATA_DIR = ""
 HOST = 'localhost'
 PORT = 8000
 
+_url = None
+_http = None
+
 def read_json(fp: str) -> dict:
     """Read data from json file"""
     d = {}
@@ -43,16 +45,26 @@ def simple_data_csv(fp, ):
     pass
 
 
-if __name__ == "__main__":
+def service_url() -> str:
+    """Service url of config.json, read on first use"""
+    global _url
+    if _url is None:
+        config = read_json(CONFIG_FILE).get('service', {})
+        _url = f"http://{config.get('host', HOST)}:{config.get('port', PORT)}"
+    return _url
+
 
+def http():
+    """requests.Session shared by every command of this process, its
+    connections to the service are kept alive"""
+    global _http
+    if _http is None:
+        import requests
+        _http = requests.Session()
+    return _http
 
-    if os.path.isfile(CONFIG_FILE):
-        config = read_json(CONFIG_FILE)
-        host = config['service']['host']
-        ip = '127.0.0.1' if host == 'localhost' else host
-        port = config['service']['port']
-        url = f"http://{host}:{port}"
 
+def build_parser() -> argparse.ArgumentParser:
     aparser = argparse.ArgumentParser("TC-Cli")
     
     sub = aparser.add_subparsers(dest="command")
@@ -79,6 +91,8 @@ if __name__ == "__main__":
     args_new_session.add_argument('-s', '--start', default=False)
     args_new_session.add_argument('-f', '--finish', default=False)
     args_new_session.add_argument('-a', '--alert', nargs='*', metavar=('min', 'max'))
+    args_new_session.add_argument('-r', '--rules', metavar='JSON',
+        help="Alert rules, a json list or a file with one")
 
     # Finish Session
     args_finish_session = session_sub.add_parser('finish', help="Finish session")
@@ -93,18 +107,89 @@ if __name__ == "__main__":
     args_info_session.add_argument('--session')
     args_info_session.add_argument('-d', '--details')
 
+    # Session data
+    args_data_session = session_sub.add_parser('data', help="Session data in a time range")
+    args_data_session.add_argument('board')
+    args_data_session.add_argument('sensor')
+    args_data_session.add_argument('session')
+    args_data_session.add_argument('--from', dest='start', metavar='DATE',
+        help="YYYY-MM-DD[ HH:MM:SS] or epoch, inclusive")
+    args_data_session.add_argument('--to', dest='end', metavar='DATE',
+        help="YYYY-MM-DD[ HH:MM:SS] or epoch, exclusive")
+    args_data_session.add_argument('-f', '--format', choices=['csv', 'json'], default='csv')
+    args_data_session.add_argument('-o', '--output', help="Output file, stdout by default")
+
+    # Session summary
+    args_summary_session = session_sub.add_parser('summary', help="Session statistics per minute, hour or day")
+    args_summary_session.add_argument('session')
+    args_summary_session.add_argument('-l', '--level', choices=['minute', 'hour', 'day'], default='hour')
+    args_summary_session.add_argument('--from', dest='start', metavar='DATE')
+    args_summary_session.add_argument('--to', dest='end', metavar='DATE')
+
     # Device
     args_device = sub.add_parser('device', help="Device info and data")
     args_device.add_argument('board')
 
+    # Logs
+    args_logs = sub.add_parser('logs', help="Service logs, oldest first")
+    args_logs.add_argument('--from', dest='start', metavar='DATE',
+        help="YYYY-MM-DD[ HH:MM:SS] or epoch, inclusive")
+    args_logs.add_argument('--to', dest='end', metavar='DATE',
+        help="YYYY-MM-DD[ HH:MM:SS] or epoch, exclusive")
+    args_logs.add_argument('-t', '--type', action='append', default=[],
+        help="alert, Data alert, error..., may be repeated")
+    args_logs.add_argument('-b', '--board')
+    args_logs.add_argument('-w', '--worker', type=int, default=0, help="with --workers, logs of worker N")
+    args_logs.add_argument('-n', '--limit', type=int, default=0, help="at most N records")
+    args_logs.add_argument('-f', '--format', choices=['csv', 'json'], default='csv')
+
     # info
     args_info = sub.add_parser('info', help="Service info")
 
     # Update
     args_update = sub.add_parser('update', help="")
-    
-    args = aparser.parse_args()
 
+    # Batch
+    args_batch = sub.add_parser('batch', help="Run commands read from a file or stdin, one per line")
+    args_batch.add_argument('file', nargs='?', default='-', help="'-' for stdin (default)")
+    args_batch.add_argument('-k', '--keep-going', action='store_true',
+        help="continue after a failed command")
+
+    return aparser
+
+
+def run_batch(aparser, fp: str, keep_going=False) -> int:
+    """Runs each line as a command line ('#' starts a comment), returns the
+    number of failed commands"""
+    f = sys.stdin if fp == '-' else open(fp, 'r')
+    failed = 0
+    for n, line in enumerate(f, 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        try:
+            run(aparser, aparser.parse_args(argv))
+        except SystemExit as e:
+            # argparse errors and --help
+            ok = not e.code
+            if not ok:
+                print(f"line {n}: {line.strip()}", file=sys.stderr)
+        except Exception as e:
+            print(f"line {n}: {e}", file=sys.stderr)
+            ok = False
+        else:
+            ok = True
+        if not ok:
+            failed += 1
+            if not keep_going:
+                break
+    if f is not sys.stdin:
+        f.close()
+    return failed
+
+
+def run(aparser, args) -> None:
+    """Runs one parsed command"""
     if args.command == 'init':
         initial_config = {
             "basedir": BASE_DIR,
@@ -119,17 +204,22 @@ if __name__ == "__main__":
     elif args.command == 'config':
         pass
 
+    elif args.command == 'batch':
+        if run_batch(aparser, args.file, args.keep_going):
+            sys.exit(1)
+
     elif args.command == 'service':    
         if args.shutdown:
-            requests.get(url+"/server/stop", params={"opt": "clean"})
+            http().get(service_url()+"/server/stop", params={"opt": "clean"})
     
     elif args.command == 'update':
-        from subprocess import run
+        from subprocess import run as run_process
 
-        requests.get(url+"/server/stop")
-        run(['bash', f"{BASE_DIR}/scripts/update.sh"])
+        http().get(service_url()+"/server/stop")
+        run_process(['bash', f"{BASE_DIR}/scripts/update.sh"])
 
     elif args.command == 'session':
+        url = service_url()
         # validar fechas y listas
         if args.session_command == 'new':
             session = {
@@ -144,25 +234,102 @@ if __name__ == "__main__":
                     "finish_date": args.finish,
                     "alert": True if args.alert else False,
                     "min_value": int(args.alert[0]) if args.alert else False,
-                    "max_value": int(args.alert[1]) if args.alert else False
+                    "max_value": int(args.alert[1]) if args.alert else False,
+                    "rules": []
                 }
             }
+            if args.rules:
+                rules = read_json(args.rules) if os.path.isfile(args.rules) else json.loads(args.rules)
+                session['session']['rules'] = rules
             print(session)
-            res = requests.post(url+"/session", data=json.dumps(session))
+            res = http().post(url+"/session", data=json.dumps(session))
             print(res)
 
         elif args.session_command == 'finish':
             opt = 'clear' if args.clear else ''
-            #board = args.board
-            #sensor = args.sensor
             session_id = args.session
-            requests.get(url+'/session/action/finish',
-                params={"board": "ESP1", "session": session_id, "option": opt})
+            sessions = http().get(url+"/session", params={"session": session_id}).json()["sessions"]
+            session = next((group[session_id] for group in sessions.values()
+                if session_id in group), None)
+            if session is None:
+                print(f"Session {session_id} not found")
+                return
+            http().get(url+'/session/action/finish',
+                params={"board": session['board'], "session": session_id, "option": opt})
 
         elif args.session_command == 'info':
-            res = requests.get(url+"/session").json()
+            res = http().get(url+"/session").json()
             print(res)
 
+        elif args.session_command == 'data':
+            params = {
+                "board": args.board,
+                "sensor": args.sensor,
+                "session": args.session,
+                "from": args.start,
+                "to": args.end,
+                "format": args.format
+            }
+            res = http().get(url+"/session/data", params=params, stream=True)
+            res.raise_for_status()
+            if not args.output:
+                sys.stdout.flush()  # text printed before, in batch mode
+            out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+            for chunk in res.iter_content(chunk_size=None):
+                out.write(chunk)
+            if args.output:
+                out.close()
+            else:
+                out.flush()
+
+        elif args.session_command == 'summary':
+            params = {
+                "session": args.session,
+                "level": args.level,
+                "from": args.start,
+                "to": args.end
+            }
+            res = http().get(url+"/session/summary", params=params).json()
+            print(f"{res['board']} {res['sensor']} {res['session']}: {res['totals']}")
+            for b in res['buckets']:
+                print(f"{b['time']}  count={b['count']} mean={b['mean']} "
+                    f"min={b['min']} max={b['max']} std={b['std']}")
+
+    elif args.command == 'logs':
+        import csv
+
+        # pages are printed as they arrive, following the cursors
+        params = {
+            "from": args.start,
+            "to": args.end,
+            "type": args.type,
+            "board": args.board,
+            "worker": args.worker
+        }
+        out = csv.writer(sys.stdout)
+        if args.format == 'csv':
+            out.writerow(['TimeStamp', 'Level', 'Type', 'Board', 'Message'])
+        left = args.limit or float('inf')
+        while left > 0:
+            params['limit'] = min(left, 1000)
+            res = http().get(service_url()+"/logs", params=params)
+            res.raise_for_status()
+            page = res.json()
+            for record in page['logs']:
+                if args.format == 'json':
+                    print(json.dumps(record))
+                else:
+                    out.writerow(record.values())
+            left -= len(page['logs'])
+            if not page['next']:
+                break
+            params['cursor'] = page['next']
+
     elif args.command == 'info':
-        res = requests.get(url).json()
-        print(res)            
\ No newline at end of file
+        res = http().get(service_url()).json()
+        print(res)
+
+
+if __name__ == "__main__":
+    aparser = build_parser()
+    run(aparser, aparser.parse_args())
@@ -1,18 +1,43 @@
-from tornado.ioloop import IOLoop
-from tornado.web import Application, RequestHandler
-from tornado.websocket import WebSocketHandler
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.web import Application, RequestHandler, HTTPError
+from tornado.websocket import WebSocketHandler, WebSocketClosedError, websocket_connect
 from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets, add_accept_handler
+from tornado.iostream import IOStream
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httputil import url_concat
+from tornado.locks import Event, Condition
+from tornado import gen
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from functools import partial
+from contextlib import contextmanager
+from operator import gt, ge, lt, le
+from hashlib import md5
+from glob import glob
 from datetime import datetime
-from threading import Thread
-from shutil import rmtree
-from time import sleep
-from socket import gethostname, gethostbyname
+from bisect import bisect_left
+from heapq import heappush, heappop
+from collections import deque
+from itertools import count
+from threading import Thread, Lock, get_ident
+from logging.handlers import QueueHandler
+from queue import Queue, Empty
+from shutil import rmtree, copyfileobj
+from time import time, perf_counter, mktime, gmtime, localtime
+from socket import gethostname, gethostbyname, socket, socketpair
+from socket import AF_UNIX, SOCK_DGRAM, SOL_SOCKET, SCM_RIGHTS, MSG_PEEK, CMSG_SPACE
 
 import os
 import sys
 import json
 import requests
 import tempfile
+import struct
+import logging
+import gzip
+import csv
+import fcntl
 
 # VERSION
 VERSION_MAJOR = 0
@@ -20,6 +45,8 @@ VERSION_MINOR = 1
 VERSION_PATCH = 0
 
 DEBUG = True if '-d' in sys.argv else False
+WORKERS = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else 1
+WORKER = 0  # this process, set after forking
 
 # DIRS AND FILES
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -29,20 +56,91 @@ DATA_DIR = f"{BASE_DIR}/data" if DEBUG else f"{HOME_DIR}/tc-data"
 SESS_DIR = f"{DATA_DIR}/sessions"
 SESS_FIL = f"{SESS_DIR}/sessions.json"
 LOG_FILE = f"{DATA_DIR}/logs.csv"
-DEV_FILE = f"{DATA_DIR}/devices.json"
+LOG_DIR  = f"{DATA_DIR}/logs"
+DEV_FILE = f"{DATA_DIR}/devices.json"   # boards of older versions, read once if there is no snapshot
+STATE_FILE = f"{DATA_DIR}/state.json"   # startup snapshot
+STATE_LOG  = f"{DATA_DIR}/state.log"    # board changes since the snapshot
 
-CLNT_WS  = None
 USER     = os.getenv("USER")
 
 # Crontab
 COMMAND  = 'curl "http://localhost:8000/data'
 COMMENT  = "# tc-server"
-
-BOARDS = {}
+CRON_TTL = float(os.getenv("TC_CRON_TTL", 60))  # seconds, when the spool file can't be checked
+CRON_SPOOL = [f"/var/spool/cron/crontabs/{USER}", f"/var/spool/cron/{USER}"]
+
+BOARDS = {}    # id -> Board
+SESSIONS = {}  # id -> running or waiting Board.Session, finished ones are archived
+
+# Session writer
+FLUSH_ROWS = int(os.getenv("TC_FLUSH_ROWS", 512))  # flush when this many rows are buffered
+FLUSH_MS   = int(os.getenv("TC_FLUSH_MS", 1000))   # flush at least every FLUSH_MS milliseconds
+
+# Write-ahead log
+WAL_ENABLED    = os.getenv("TC_WAL", "on") != "off"
+WAL_SYNC_MS    = int(os.getenv("TC_WAL_SYNC_MS", 200))       # fsync the log at least this often
+WAL_SYNC_ROWS  = int(os.getenv("TC_WAL_SYNC_ROWS", 4096))    # or once this many rows are pending
+WAL_CHECKPOINT = float(os.getenv("TC_WAL_CHECKPOINT", 60))   # seconds, storages fsynced and log trimmed
+WAL_DIR        = f"{DATA_DIR}/wal"
+
+# Session storage
+STORAGE         = os.getenv("TC_STORAGE", "csv")              # csv or bin
+SEGMENT_RECORDS = int(os.getenv("TC_SEGMENT_RECORDS", 1 << 20))  # records per bin segment
+INDEX_EVERY     = int(os.getenv("TC_INDEX_EVERY", 1024))     # csv rows per sparse index entry
+QUERY_CHUNK     = 4096                                        # rows per streamed chunk
+
+# Session rollups
+ROLLUP_MINUTES = int(os.getenv("TC_ROLLUP_MINUTES", 1440))  # minute buckets kept per session
+ROLLUP_HOURS   = int(os.getenv("TC_ROLLUP_HOURS", 24 * 90))  # hour buckets kept per session
+ROLLUP_SAVE_MS = int(os.getenv("TC_ROLLUP_SAVE_MS", 10000))  # save interval of changed rollups
+
+# Interval polling
+INTERVALS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+BOARD_CONCURRENCY = int(os.getenv("TC_BOARD_CONCURRENCY", 2))  # board requests in flight
+COALESCE_MS       = int(os.getenv("TC_COALESCE_MS", 500))      # polls this close share a request
+
+# Client websockets
+CLIENT_QUEUE  = int(os.getenv("TC_CLIENT_QUEUE", 256))    # frames queued per client
+MAX_PUSH_RATE = float(os.getenv("TC_MAX_PUSH_RATE", 50))  # frames/s of a push policy
+PUSH_WINDOW   = int(os.getenv("TC_PUSH_WINDOW", 10000))   # samples kept per series and window
+
+# Ingest pipeline
+INGEST_QUEUE  = int(os.getenv("TC_INGEST_QUEUE", 10000))  # frames between receive and storage
+INGEST_BATCH  = int(os.getenv("TC_INGEST_BATCH", 256))    # frames per consumer round
+INGEST_POLICY = os.getenv("TC_INGEST_POLICY", "pause")    # pause, drop or spill when full
+SPILL_DIR     = f"{DATA_DIR}/spill"
+
+# Session index
+SAVE_DELAY = float(os.getenv("TC_SAVE_DELAY", 1))  # seconds between sessions.json writes
+
+# Server
+PORT          = int(os.getenv("TC_PORT", 8000))
+INTERNAL_PORT = int(os.getenv("TC_INTERNAL_PORT", 8100))  # worker N listens on 127.0.0.1:INTERNAL_PORT+N
+RELAY_MS      = int(os.getenv("TC_RELAY_MS", 50))         # live values batched to worker 0
+
+# Async I/O
+IO_WORKERS   = int(os.getenv("TC_IO_WORKERS", 4))       # threads for file and subprocess work
+HTTP_TIMEOUT = float(os.getenv("TC_HTTP_TIMEOUT", 5))   # seconds, board requests
 
 TELEGRAM_TOKEN  = os.getenv("TGTOKEN", '')
 TELEGRAM_CHATID = os.getenv("TGCHATID", '')
 
+# Logs
+LOG_LEVEL     = os.getenv("TC_LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("TC_LOG_MAX_BYTES", 8 << 20))  # rotate logs.csv at this size
+LOG_ROTATE    = float(os.getenv("TC_LOG_ROTATE", 86400))     # or at this age, seconds
+LOG_TAIL      = int(os.getenv("TC_LOG_TAIL", 100))           # newest records kept in memory
+LOG_PAGE      = 100                                          # records per /logs page
+LOG_PAGE_MAX  = 1000
+LOG_LEVELS    = {"error": logging.ERROR, "Data alert": logging.WARNING}  # by type, default INFO
+TRACE         = LOG_LEVEL == "DEBUG"  # every board message is logged
+
+# Alerts
+NOTIFY_URL       = os.getenv("TC_NOTIFY_URL", "https://api.telegram.org/bot{token}/sendMessage")
+NOTIFY_QUEUE     = int(os.getenv("TC_NOTIFY_QUEUE", 100))         # notifications waiting to be sent
+ALERT_COOLDOWN   = float(os.getenv("TC_ALERT_COOLDOWN", 300))     # seconds between a session's notifications
+ALERT_HYSTERESIS = float(os.getenv("TC_ALERT_HYSTERESIS", 0.05))  # of the min-max width, to leave an alert
+
 
 #########
 # Utils #
@@ -57,6 +155,23 @@ def time_stamp() -> str:
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
 
+def query_time(arg) -> int:
+    """Epoch seconds from a query argument: epoch, 'YYYY-MM-DD' or
+    'YYYY-MM-DD HH:MM:SS' in local time"""
+    if arg is None or arg == '':
+        return None
+    if arg.isdigit():
+        return int(arg)
+    if len(arg) == 10:
+        arg += ' 00:00:00'
+    return int(mktime(datetime.strptime(arg, '%Y-%m-%d %H:%M:%S').timetuple()))
+
+
+def is_number(x) -> bool:
+    """int or float, not bool (the cli sends False for unset values)"""
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
 def read_json(fp: str) -> dict:
     """Read data from json file"""
     d = {}
@@ -74,6 +189,21 @@ def write_json(fp: str, data: dict) -> None:
     f.close()
 
 
+def replace_json(fp: str, data: dict) -> None:
+    """Write compact json to a temp file and rename it over fp, readers
+    see either the old or the new file, never a partial one"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fp), prefix=f".{os.path.basename(fp)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fp)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
 def write_data(fp: str, data: str) -> None:
     """Write data in csv format"""
     if os.path.isfile(fp):
@@ -83,14 +213,430 @@ def write_data(fp: str, data: str) -> None:
         f.close()
 
 
-def log(fp, log_type, msg, telegram=False) -> None:
-    timestamp = time_stamp()
-    write_data(fp, f"{timestamp},{log_type},{msg}")
+def log(log_type, msg, telegram=False, board=None, level=None) -> None:
+    """Queues a record for the log writer, see Logs"""
+    level = level or LOG_LEVELS.get(log_type, logging.INFO)
+    LOGGER.log(level, msg, extra={"type": log_type, "board": board})
     if telegram and not DEBUG:
-        msg = f"{log_type.upper()}: {msg} at {timestamp}"
-        telegram_msg(msg)
-    else:
-        print(msg)
+        telegram_msg(f"{log_type.upper()}: {msg} at {time_stamp()}")
+
+
+#########
+# Async #
+#########
+
+# Blocking file and subprocess work runs here so the IOLoop keeps serving
+# websockets while a disk or crontab call is slow.
+EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="tc-io")
+
+
+def run_io(fn, *args):
+    """Run a blocking call in the I/O thread pool, returns an awaitable"""
+    return IOLoop.current().run_in_executor(EXECUTOR, fn, *args)
+
+
+async def fetch(url: str, params: dict = None) -> str:
+    """Non-blocking GET request, returns the response body"""
+    if params:
+        url = url_concat(url, params)
+    res = await AsyncHTTPClient().fetch(url, request_timeout=HTTP_TIMEOUT)
+    return res.body.decode()
+
+
+###########
+# Metrics #
+###########
+
+# Counters and histograms served on /metrics in the Prometheus text format.
+# Every thread updates its own shard (a dict keyed by label values), so the
+# hot paths never take a lock; a scrape sums the shards.
+
+METRICS = []
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if WORKERS > 1:
+        pairs.append(f'worker="{WORKER}"')
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._shards = {}  # thread id -> {label values: value}
+        METRICS.append(self)
+
+    def _shard(self) -> dict:
+        ident = get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            shard = self._shards[ident] = {}
+        return shard
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels: tuple = (), n=1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + n
+
+    def lines(self) -> list:
+        total = {}
+        for shard in list(self._shards.values()):
+            for labels, value in list(shard.items()):
+                total[labels] = total.get(labels, 0) + value
+        return [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in total.items()]
+
+
+class Histogram(Metric):
+    """Cumulative buckets in seconds, observed with one bisect"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # a count per bucket, +Inf, then the sum
+            cell = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def lines(self) -> list:
+        total = {}
+        for shard in list(self._shards.values()):
+            for labels, cell in list(shard.items()):
+                t = total.get(labels)
+                total[labels] = list(cell) if t is None else [a + b for a, b in zip(t, cell)]
+        out = []
+        for labels, cell in total.items():
+            n = 0
+            for bound, hits in zip(self.buckets + ('+Inf',), cell):
+                n += hits
+                le = 'le="%s"' % bound
+                out.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {n}")
+            out.append(f"{self.name}_sum{_labels(self.labels, labels)} {cell[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labels, labels)} {n}")
+        return out
+
+
+class Gauge(Metric):
+    """Read at scrape time from fn()"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, doc: str, fn):
+        super().__init__(name, doc)
+        self.fn = fn
+
+    def lines(self) -> list:
+        return [f"{self.name}{_labels((), ())} {self.fn()}"]
+
+
+def metrics_lines() -> dict:
+    """name -> sample lines of every metric in this process"""
+    return {m.name: m.lines() for m in METRICS}
+
+
+def render_metrics(others: list = ()) -> str:
+    """Text exposition, with the samples of other workers merged in"""
+    out = []
+    for m in METRICS:
+        out.append(f"# HELP {m.name} {m.doc}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.lines())
+        for lines in others:
+            out.extend(lines.get(m.name, ()))
+    return '\n'.join(out) + '\n'
+
+
+BOARD_MESSAGES = Counter('tc_board_messages_total', "Values received from boards", ('board', 'sensor'))
+BAD_FRAMES     = Counter('tc_board_bad_frames_total', "Malformed board frames dropped", ('board',))
+ON_MESSAGE     = Histogram('tc_on_message_seconds', "Board websocket on_message handling time")
+SESSION_WRITE  = Histogram('tc_session_write_seconds', "Session.write and Session.store time")
+WRITER_FLUSH   = Histogram('tc_writer_flush_seconds', "SessionWriter batch write time")
+WRITER_BYTES   = Counter('tc_writer_bytes_total', "Bytes appended to session storage", ('storage',))
+WAL_COMMIT     = Histogram('tc_wal_commit_seconds', "Write-ahead log write and fsync time")
+SESSIONS_SAVE  = Histogram('tc_sessions_persist_seconds', "sessions.json write time")
+CRONTAB_CALLS  = Counter('tc_crontab_calls_total', "crontab subprocess invocations", ('command',))
+CRONTAB_TIME   = Histogram('tc_crontab_seconds', "crontab subprocess time", ('command',))
+BOARD_POLL     = Histogram('tc_board_poll_seconds', "Board /data request time", ('board',))
+POLL_ERRORS    = Counter('tc_board_poll_errors_total', "Failed board /data requests", ('board',))
+ALERT_CHANGES  = Counter('tc_alert_changes_total', "Alert state changes by new level", ('level',))
+NOTIFICATIONS  = Counter('tc_notifications_total', "Notifications by result", ('result',))
+
+Gauge('tc_boards_connected', "Open board websockets", lambda: WebsocketDataListener.connected)
+Gauge('tc_clients_connected', "Open client websockets", lambda: len(Hub._clients))
+Gauge('tc_ingest_queued', "Frames waiting in the ingest queue", lambda: len(Ingest._queue))
+Gauge('tc_writer_buffered_rows', "Rows waiting for the session writer", lambda: SessionWriter._buffered)
+
+
+########
+# Logs #
+########
+
+# log() only builds a record and puts it on a queue; one writer thread
+# appends the queued records to LOG_FILE as csv rows, flushing once per
+# batch. The file is rotated into LOG_DIR as a gzipped segment once it
+# reaches LOG_MAX_BYTES or LOG_ROTATE seconds of age. Records below
+# LOG_LEVEL are dropped by the logger before anything is built.
+#
+# Every rotated segment has an entry in LOG_DIR/logs.index.json with its
+# time range, record count, types and boards, so a query only opens the
+# segments that can have matching records.
+
+LOGGER = logging.getLogger("tc")
+LOG_HEADER = ["TimeStamp", "Level", "Type", "Board", "Message"]
+
+
+class Logs:
+
+    _queue = Queue()
+    _thread = None
+    _file = None
+    _writer = None
+    _size = 0
+    _opened = 0.0     # time of the segment's first record
+    _index_lock = Lock()
+    tail = deque(maxlen=LOG_TAIL)  # newest records, for /
+    count = 0         # records written since start
+
+    @classmethod
+    def start(cls) -> None:
+        """Opens LOG_FILE and starts the writer, after forking"""
+        os.makedirs(LOG_DIR, exist_ok=True)
+        cls._open()
+        LOGGER.setLevel(LOG_LEVEL)
+        LOGGER.propagate = False
+        LOGGER.addHandler(QueueHandler(cls._queue))
+        cls._thread = Thread(target=cls._run, name="tc-log", daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def stop(cls) -> None:
+        """Writes the queued records and stops the writer (blocking)"""
+        if cls._thread is not None:
+            cls._queue.put(None)
+            cls._thread.join()
+            cls._thread = None
+
+    @classmethod
+    def _open(cls) -> None:
+        first = None
+        if os.path.isfile(LOG_FILE):
+            with open(LOG_FILE, 'r', newline='') as f:
+                rows = csv.reader(f)
+                header = next(rows, None)
+                first = next(rows, None)
+            # older logs.csv files have another header, they become a segment
+            if header != LOG_HEADER:
+                cls._rotate(cls._first_time(first))
+                first = None
+        cls._file = open(LOG_FILE, 'a', newline='')
+        cls._writer = csv.writer(cls._file)
+        cls._size = cls._file.tell()
+        if not cls._size:
+            cls._writer.writerow(LOG_HEADER)
+            cls._size = cls._file.tell()
+        cls._opened = cls._first_time(first)
+
+    @staticmethod
+    def _first_time(row) -> float:
+        """Epoch of a row's TimeStamp, now if there is none"""
+        try:
+            return mktime(datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S').timetuple())
+        except (TypeError, IndexError, ValueError):
+            return time()
+
+    @classmethod
+    def _rotate(cls, opened: float) -> None:
+        """Moves LOG_FILE to a gzipped segment named after its first record"""
+        if cls._file is not None:
+            cls._file.close()
+            cls._file = None
+        name = cls._name()
+        stamp = cls._key(opened)
+        fp, n = f"{LOG_DIR}/{name}.{stamp}.csv.gz", 1
+        while os.path.exists(fp):
+            fp, n = f"{LOG_DIR}/{name}.{stamp}-{n}.csv.gz", n + 1
+        entry = cls._scan(LOG_FILE)
+        with open(LOG_FILE, 'rb') as src, gzip.open(f"{fp}.tmp", 'wb') as dst:
+            copyfileobj(src, dst)
+        os.replace(f"{fp}.tmp", fp)
+        os.remove(LOG_FILE)
+        cls._add_to_index(os.path.basename(fp), entry)
+
+    @classmethod
+    def _run(cls) -> None:
+        """Writer thread"""
+        while True:
+            records = [cls._queue.get()]
+            while True:
+                try:
+                    records.append(cls._queue.get_nowait())
+                except Empty:
+                    break
+            for record in records:
+                if record is None:
+                    cls._file.close()
+                    return
+                cls._write(record)
+            cls._file.flush()
+            cls._size = cls._file.tell()
+            if cls._size >= LOG_MAX_BYTES or time() - cls._opened >= LOG_ROTATE:
+                try:
+                    cls._rotate(cls._opened)
+                except OSError as e:
+                    print(f"Log rotation failed: {e}", file=sys.stderr)
+                cls._open()
+
+    @classmethod
+    def _write(cls, record) -> None:
+        row = [
+            datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S'),
+            record.levelname,
+            record.type,
+            record.board or '',
+            record.getMessage()
+        ]
+        cls._writer.writerow(row)
+        cls.tail.append(dict(zip(LOG_HEADER, row)))
+        cls.count += 1
+        if DEBUG:
+            print(' '.join(row[2:]))
+
+    @classmethod
+    def _name(cls) -> str:
+        return os.path.splitext(os.path.basename(LOG_FILE))[0]
+
+    @staticmethod
+    def _key(opened: float) -> str:
+        return datetime.fromtimestamp(opened).strftime('%Y%m%d-%H%M%S')
+
+    @classmethod
+    def _rows(cls, fp: str):
+        """(row number, row) of a log file or gzipped segment, rows of
+        older files padded to LOG_HEADER"""
+        opener = gzip.open if fp.endswith('.gz') else open
+        with opener(fp, 'rt', newline='') as f:
+            rows = csv.reader(f)
+            header = next(rows, None)
+            for n, row in enumerate(rows, 1):
+                if header != LOG_HEADER and len(row) >= 3:
+                    # TimeStamp, Type, Message with unquoted commas
+                    level = logging.getLevelName(LOG_LEVELS.get(row[1], logging.INFO))
+                    row = [row[0], level, row[1], '', ','.join(row[2:])]
+                if len(row) == len(LOG_HEADER):
+                    yield n, row
+
+    @classmethod
+    def _scan(cls, fp: str) -> dict:
+        """Index entry of a segment: time range, count, types and boards"""
+        start = end = ''
+        count = 0
+        types, boards = set(), set()
+        for _, row in cls._rows(fp):
+            start = start or row[0]
+            end = row[0]
+            count += 1
+            types.add(row[2])
+            if row[3]:
+                boards.add(row[3])
+        return {"start": start, "end": end, "count": count,
+            "types": sorted(types), "boards": sorted(boards)}
+
+    @classmethod
+    def _add_to_index(cls, segment: str, entry: dict) -> None:
+        with cls._index_lock:
+            fp = f"{LOG_DIR}/{cls._name()}.index.json"
+            index = read_json(fp)
+            index[segment] = entry
+            replace_json(fp, index)
+
+    @classmethod
+    def _segments(cls) -> list:
+        """(key, path, index entry) of the rotated segments, oldest first,
+        then the current file with no entry. Segments rotated before the
+        index existed are indexed here, once."""
+        name = cls._name()
+        fp = f"{LOG_DIR}/{name}.index.json"
+        with cls._index_lock:
+            index = read_json(fp)
+            # logs.w1.* segments match the logs.* pattern too
+            missing = [f for f in glob(f"{LOG_DIR}/{name}.*.csv.gz")
+                if os.path.basename(f) not in index
+                and os.path.basename(f)[len(name) + 1:][:8].isdigit()]
+            for f in missing:
+                index[os.path.basename(f)] = cls._scan(f)
+            if missing:
+                replace_json(fp, index)
+        segments = sorted((seg[len(name) + 1:-len('.csv.gz')], f"{LOG_DIR}/{seg}", entry)
+            for seg, entry in index.items() if os.path.isfile(f"{LOG_DIR}/{seg}"))
+        segments.append((cls._key(cls._opened), LOG_FILE, None))
+        return segments
+
+    @classmethod
+    def query(cls, start=None, end=None, types=(), board=None, cursor=None, limit=LOG_PAGE) -> tuple:
+        """(records, next cursor or None) in [start, end) with any of types
+        and of board, oldest first. Segments whose index entry can't match
+        are never opened. A cursor is "segment key.row" (blocking)."""
+        fmt = '%Y-%m-%d %H:%M:%S'
+        lo = datetime.fromtimestamp(start).strftime(fmt) if start is not None else ''
+        hi = datetime.fromtimestamp(end).strftime(fmt) if end is not None else None
+        after, skip = cursor.rsplit('.', 1) if cursor else ('', 0)
+        skip = int(skip)
+        types = set(types)
+        records = []
+        for key, fp, seg in cls._segments():
+            if key < after:
+                continue
+            if seg is not None:
+                if not seg['count'] or seg['end'] < lo or (hi is not None and seg['start'] >= hi):
+                    continue
+                if types and types.isdisjoint(seg['types']) or board and board not in seg['boards']:
+                    continue
+            first = skip if key == after else 0
+            try:
+                for n, row in cls._rows(fp):
+                    if n <= first or row[0] < lo:
+                        continue
+                    if hi is not None and row[0] >= hi:
+                        return records, None
+                    if types and row[2] not in types or board and row[3] != board:
+                        continue
+                    records.append(dict(zip(LOG_HEADER, row)))
+                    if len(records) == limit:
+                        return records, f"{key}.{n}"
+            except FileNotFoundError:
+                # rotated meanwhile, its rows are in the next query's segments
+                continue
+        return records, None
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "len": cls.count,
+            "last_log": cls.tail[-1] if cls.tail else {}
+        }
 
 
 ############
@@ -99,21 +645,7 @@ def log(fp, log_type, msg, telegram=False) -> None:
 
 
 def telegram_msg(msg) -> None:
-    
-    def send(msg) -> None:
-        url = "https://api.telegram.org"
-        query = f"/bot{TELEGRAM_TOKEN}/sendMessage?chat_id={TELEGRAM_CHATID}&" \
-                f"parse_mode=Markdown&text={msg}"
-        res = None
-        try:
-            res = requests.get(url + query).json()
-            if not res['ok']:
-                pass
-        except Exception:
-            pass
-    
-    t = Thread(target=send, args=(msg,))
-    t.start()
+    Notifier.send(msg)
 
 
 ###########
@@ -161,15 +693,71 @@ class CronTab:
             return self.get_cron()
 
     jobs = []
+    _lock = Lock()  # read-modify-write of the crontab runs in worker threads
+    _lock_file = f"{DATA_DIR}/crontab.lock"  # and with --workers in other processes
+
+    # Mirror of the installed crontab. It is refreshed when the spool file
+    # changes, or every CRON_TTL seconds when the spool can't be read, and
+    # replaced by what we install ourselves.
+    _cache = None
+    _cache_mtime = None
+    _cache_time = 0.0
+    _has_jobs = False
 
     @staticmethod
-    def _get_cronjobs() -> list:
+    def _spool_mtime():
+        for fp in CRON_SPOOL:
+            try:
+                return os.stat(fp).st_mtime
+            except OSError:
+                continue
+        return None
 
-        from subprocess import Popen, PIPE
-    
-        process = Popen(['crontab', '-u', USER, '-l'], stdout=PIPE, stderr=PIPE)
-        lines = process.stdout.readlines()
-        return [ j.decode() for j in lines]
+    @staticmethod
+    def _read_crontab() -> list:
+
+        from subprocess import run, PIPE
+
+        t0 = perf_counter()
+        process = run(['crontab', '-u', USER, '-l'], stdout=PIPE, stderr=PIPE)
+        CRONTAB_CALLS.inc(('list',))
+        CRONTAB_TIME.observe(perf_counter() - t0, ('list',))
+        return process.stdout.decode().splitlines(keepends=True)
+
+    @classmethod
+    def _set_cache(cls, lines: list, mtime) -> None:
+        cls._cache = lines
+        cls._cache_mtime = mtime
+        cls._cache_time = time()
+        cls._has_jobs = any(COMMENT in line for line in lines)
+
+    @classmethod
+    @contextmanager
+    def _locked(cls):
+        """Read-modify-write section. With --workers the other processes
+        change the crontab too, the cache is not trusted inside it."""
+        with cls._lock:
+            if WORKERS == 1:
+                yield
+                return
+            with open(cls._lock_file, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    cls._cache = None
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @classmethod
+    def _get_cronjobs(cls) -> list:
+        mtime = cls._spool_mtime()
+        if cls._cache is not None:
+            if mtime is not None and mtime == cls._cache_mtime:
+                return list(cls._cache)
+            if mtime is None and time() - cls._cache_time < CRON_TTL:
+                return list(cls._cache)
+        cls._set_cache(cls._read_crontab(), mtime)
+        return list(cls._cache)
 
     @classmethod
     def job_exist(cls, command) -> bool:
@@ -180,10 +768,8 @@ class CronTab:
 
     @classmethod
     def jobs_exist(cls) -> bool:
-        for line in cls._get_cronjobs():
-            if COMMENT in line:
-                return True
-        return False
+        cls._get_cronjobs()
+        return cls._has_jobs
 
     @classmethod
     def new_job(cls, command):
@@ -196,48 +782,1112 @@ class CronTab:
 
     @classmethod
     def remove_job(cls, job) -> None:
-        jobs = cls._get_cronjobs()
-        for cjob, ljob in zip(jobs, cls.jobs):
-            if job in cjob:
-                jobs.remove(cjob)
-            if cjob in str(ljob):
-                cls.jobs.remove(ljob)
-        
-        cls._write(jobs)
+        with cls._locked():
+            jobs = [line for line in cls._get_cronjobs() if job not in line]
+            cls.jobs = [j for j in cls.jobs if job not in str(j)]
+            cls._write(jobs)
         
     @classmethod
     def clear_jobs(cls) -> None:
-        jobs = cls._get_cronjobs()
-        for job in jobs.copy():
-            if COMMENT in job:
-                jobs.remove(job)
+        with cls._locked():
+            jobs = [line for line in cls._get_cronjobs() if COMMENT not in line]
             cls.jobs = []
-        cls._write(jobs)
+            cls._write(jobs)
 
     @classmethod
     def _write(cls, jlist):
+        """Install jlist as the whole crontab, one crontab call"""
 
         from subprocess import run
         
+        lines = [f"{job}" for job in jlist]
         f, fp = tempfile.mkstemp()
         with os.fdopen(f, 'wb') as tmpf:
-            for job in jlist:
-                tmpf.write(bytes(f"{job}".encode()))
-        tmpf.close()
+            tmpf.write("".join(lines).encode())
 
+        t0 = perf_counter()
         run(["crontab", "-u", USER, fp])
+        CRONTAB_CALLS.inc(('install',))
+        CRONTAB_TIME.observe(perf_counter() - t0, ('install',))
         os.remove(fp)
+        cls._set_cache(lines, cls._spool_mtime())
 
     @classmethod
     def write(cls) -> None:
-        all_jobs = cls._get_cronjobs()    
-        jlist = []
+        with cls._locked():
+            all_jobs = cls._get_cronjobs()    
+            jlist = []
 
-        for job in cls.jobs:
-            if str(job) not in all_jobs:
-                jlist.append(job)
+            for job in cls.jobs:
+                if str(job) not in all_jobs:
+                    jlist.append(job)
 
-        cls._write(all_jobs+jlist)
+            if jlist:
+                cls._write(all_jobs+jlist)
+
+
+###########
+# Storage #
+###########
+
+# Session storage backends. Both take rows as (epoch seconds, value) and
+# are only used from the SessionWriter thread once the session is running.
+# numpy is only needed to read data back, never on the ingest path.
+
+def _ts_formatter():
+    """'%Y-%m-%d %H:%M:%S' local time formatter caching the last second,
+    rows come in order so most of them share it"""
+    last = [None, None]
+
+    def fmt(ts: int) -> str:
+        if ts != last[0]:
+            last[0] = ts
+            last[1] = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+        return last[1]
+    return fmt
+
+
+def _parse_ts(s: str) -> int:
+    """Epoch seconds of a 'YYYY-MM-DD HH:MM:SS' local time"""
+    return int(mktime(datetime.strptime(s, '%Y-%m-%d %H:%M:%S').timetuple()))
+
+
+INDEX_ENTRY = struct.Struct('<qq')  # epoch seconds, byte offset of the row
+
+
+class CsvStorage:
+    """TimeStamp,Value text file, one row per sample.
+
+    A sparse index ({path}.idx) stores the byte offset of one row every
+    INDEX_EVERY rows, so a time range query seeks close to its first row
+    instead of scanning the file. Files written before the index existed
+    get one built on first use.
+    """
+
+    name = 'csv'
+    extension = 'csv'
+    header = 'TimeStamp,Value\n'
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self._file = None
+        self._index = None
+        self._size = 0
+        self._since_index = 0
+        self._format = _ts_formatter()
+
+    def create(self) -> None:
+        if not os.path.isfile(self.path):
+            with open(self.path, 'w+') as f:
+                f.write(self.header)
+
+    def _open(self) -> None:
+        self._drop_torn()
+        self.load_index()
+        self._file = open(self.path, 'a')
+        self._size = self._file.tell()
+        self._since_index = INDEX_EVERY  # index the first row appended
+        self._index = open(self.index_path, 'ab')
+
+    def _drop_torn(self) -> None:
+        """Truncates a last row without its newline, left by a crash"""
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if not size:
+                return
+            f.seek(max(0, size - 4096))
+            tail = f.read()
+            if not tail.endswith(b'\n'):
+                f.truncate(size - len(tail) + tail.rfind(b'\n') + 1)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def position(self) -> int:
+        """Byte size of the file, rows appended so far included"""
+        return self._size if self._file else os.path.getsize(self.path)
+
+    def recover(self, position=None) -> int:
+        """Drops a torn last row, returns the rows after position (a
+        previous position(), the header if None)"""
+        self._drop_torn()
+        n = 0
+        with open(self.path, 'rb') as f:
+            f.seek(len(self.header) if position is None else position)
+            for block in iter(partial(f.read, 1 << 20), b''):
+                n += block.count(b'\n')
+        return n
+
+    def sync(self) -> None:
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            os.fsync(self._index.fileno())
+        elif os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                os.fsync(f.fileno())
+
+    def append(self, rows: list) -> int:
+        if self._file is None:
+            self._open()
+        lines = []
+        entries = []
+        size = self._size
+        since = self._since_index
+        for ts, value in rows:
+            line = f"{self._format(ts)},{value}\n"
+            if since >= INDEX_EVERY:
+                entries.append(INDEX_ENTRY.pack(ts, size))
+                since = 0
+            since += 1
+            size += len(line)
+            lines.append(line)
+        self._file.write("".join(lines))
+        self._file.flush()
+        if entries:
+            self._index.write(b"".join(entries))
+            self._index.flush()
+        written = size - self._size
+        self._size = size
+        self._since_index = since
+        return written
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._index = None
+
+    def remove(self) -> None:
+        self.close()
+        for fp in (self.path, self.index_path):
+            if os.path.isfile(fp):
+                os.remove(fp)
+
+    def load_index(self) -> list:
+        """[(ts, offset), ...], rebuilt if missing or behind the data file"""
+        entries = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+            entries = list(INDEX_ENTRY.iter_unpack(data))
+        size = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+        if (entries and entries[-1][1] >= size) or (not entries and size > len(self.header)):
+            entries = self.build_index()
+        return entries
+
+    def build_index(self) -> list:
+        entries = []
+        with open(self.path, 'rb') as f:
+            offset = len(f.readline())
+            for n, line in enumerate(f):
+                if n % INDEX_EVERY == 0:
+                    entries.append((_parse_ts(line[:19].decode()), offset))
+                offset += len(line)
+        with open(self.index_path, 'wb') as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*e) for e in entries))
+        return entries
+
+    def iter_lines(self, start=None, end=None, chunk=QUERY_CHUNK):
+        """Yield lists of up to chunk 'TimeStamp,Value' lines with
+        start <= ts < end (epoch seconds). Timestamps are compared as
+        strings, the format sorts chronologically."""
+        entries = self.load_index()
+        offset = len(self.header)
+        if start is not None:
+            i = bisect_left([e[0] for e in entries], start)
+            if i:
+                offset = entries[i - 1][1]
+        fmt = _ts_formatter()
+        lo = fmt(start).encode() if start is not None else None
+        hi = fmt(end).encode() if end is not None else None
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            lines = []
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # row still being written
+                ts = line[:19]
+                if lo and ts < lo:
+                    continue
+                if hi and ts >= hi:
+                    break
+                lines.append(line[:-1].decode())
+                if len(lines) >= chunk:
+                    yield lines
+                    lines = []
+            if lines:
+                yield lines
+
+    def read(self, start=None, end=None):
+        """Rows with start <= ts < end as a numpy record array"""
+        import numpy as np
+
+        lines = [line for lines in self.iter_lines(start, end) for line in lines]
+        if not lines:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        data = np.loadtxt(lines, delimiter=',', ndmin=1,
+            dtype=[('ts', 'datetime64[s]'), ('value', '<i8')])
+        arr = np.empty(len(data), dtype=RECORD_DTYPE)
+        arr['ts'] = _local_to_epoch(data['ts'].astype('<i8'))
+        arr['value'] = data['value']
+        return arr
+
+
+RECORD = struct.Struct('<qi')  # epoch seconds, value
+VALUE_MIN, VALUE_MAX = -2**31, 2**31 - 1  # what RECORD's value holds
+RECORD_DTYPE = [('ts', '<i8'), ('value', '<i4')]
+
+
+def _local_to_epoch(naive):
+    """Epoch seconds of naive local times (numpy int64 array). The UTC
+    offset is resolved once per distinct hour, not per row."""
+    import numpy as np
+
+    hours, inverse = np.unique(naive // 3600, return_inverse=True)
+    offsets = np.array([h * 3600 - mktime(gmtime(h * 3600)[:8] + (-1,)) for h in hours.tolist()],
+        dtype='<i8')
+    return naive - offsets[inverse.reshape(-1)]
+
+
+def _time_slice(arr, start=None, end=None):
+    """View of the rows of a ts-sorted array with start <= ts < end"""
+    lo = 0 if start is None else arr['ts'].searchsorted(start, 'left')
+    hi = len(arr) if end is None else arr['ts'].searchsorted(end, 'left')
+    return arr[lo:hi]
+
+
+class BinaryStorage:
+    """Fixed-width records in append-only segment files.
+
+    The session path is a directory holding 000000.seg, 000001.seg, ...
+    Each segment has up to SEGMENT_RECORDS records of RECORD (12 bytes), so
+    a segment can be memory-mapped and sliced without parsing.
+    """
+
+    name = 'bin'
+    extension = 'tcb'
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._segment = 0
+        self._records = 0
+        self._unsynced = set()  # closed segments written since the last sync
+
+    def _segment_path(self, n: int) -> str:
+        return f"{self.path}/{n:06d}.seg"
+
+    def segments(self) -> list:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(f"{self.path}/{f}" for f in os.listdir(self.path) if f.endswith('.seg'))
+
+    def create(self) -> None:
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _open(self) -> None:
+        segments = self.segments()
+        self._segment = len(segments) - 1 if segments else 0
+        fp = self._segment_path(self._segment)
+        self._file = open(fp, 'ab')
+        size = self._file.tell()
+        if size % RECORD.size:
+            # drop a record torn by a crash
+            size -= size % RECORD.size
+            self._file.truncate(size)
+            self._file.seek(size)
+        self._records = size // RECORD.size
+
+    def append(self, rows: list) -> int:
+        if self._file is None:
+            self._open()
+        written = 0
+        while rows:
+            if self._records >= SEGMENT_RECORDS:
+                self._file.close()
+                self._unsynced.add(self._segment)
+                self._segment += 1
+                self._file = open(self._segment_path(self._segment), 'ab')
+                self._records = 0
+            chunk = rows[:SEGMENT_RECORDS - self._records]
+            rows = rows[len(chunk):]
+            data = b"".join(RECORD.pack(ts, value) for ts, value in chunk)
+            self._file.write(data)
+            self._records += len(chunk)
+            written += len(data)
+        self._file.flush()
+        return written
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._unsynced.add(self._segment)
+            self._file = None
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.isdir(self.path):
+            rmtree(self.path)
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def position(self) -> int:
+        """Records stored so far, segments before the last are full"""
+        if self._file:
+            return self._segment * SEGMENT_RECORDS + self._records
+        segments = self.segments()
+        if not segments:
+            return 0
+        return (len(segments) - 1) * SEGMENT_RECORDS + os.path.getsize(segments[-1]) // RECORD.size
+
+    def recover(self, position=None) -> int:
+        """Drops a torn last record, returns the records after position"""
+        if self._file is None:
+            self._open()
+        return self.position() - (position or 0)
+
+    def sync(self) -> None:
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        for n in self._unsynced:
+            fp = self._segment_path(n)
+            if os.path.isfile(fp):
+                with open(fp, 'rb') as f:
+                    os.fsync(f.fileno())
+        self._unsynced.clear()
+
+    def _views(self, start=None, end=None):
+        """Memory-mapped slices of the segments overlapping [start, end).
+        The first and last record of each segment act as its index."""
+        import numpy as np
+
+        for fp in self.segments():
+            n = os.path.getsize(fp) // RECORD.size
+            if not n:
+                continue
+            seg = np.memmap(fp, dtype=RECORD_DTYPE, mode='r', shape=(n,))
+            if end is not None and seg['ts'][0] >= end:
+                break
+            if start is not None and seg['ts'][-1] < start:
+                continue
+            yield _time_slice(seg, start, end)
+
+    def iter_lines(self, start=None, end=None, chunk=QUERY_CHUNK):
+        """Yield lists of up to chunk 'TimeStamp,Value' lines with
+        start <= ts < end (epoch seconds)"""
+        fmt = _ts_formatter()
+        for view in self._views(start, end):
+            for i in range(0, len(view), chunk):
+                yield [f"{fmt(ts)},{value}" for ts, value in view[i:i + chunk].tolist()]
+
+    def read(self, start=None, end=None):
+        """Rows with start <= ts < end. A range inside one segment is a
+        zero-copy view of the memory-mapped file."""
+        import numpy as np
+
+        views = list(self._views(start, end))
+        if not views:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return views[0] if len(views) == 1 else np.concatenate(views)
+
+
+STORAGES = {
+    CsvStorage.name: CsvStorage,
+    BinaryStorage.name: BinaryStorage
+}
+
+
+def open_storage(kind: str, base: str):
+    """Storage of the given kind for a session path without extension"""
+    cls = STORAGES[kind]
+    return cls(f"{base}.{cls.extension}")
+
+
+def session_storage(session: dict):
+    """Storage of a session record, for reading"""
+    return STORAGES[session.get('storage', CsvStorage.name)](session['file'])
+
+
+#################
+# SessionWriter #
+#################
+
+class SessionWriter:
+    """Buffered writer for session storage.
+
+    Rows are kept in memory per session and written in batches, either when
+    FLUSH_ROWS rows are pending or every FLUSH_MS milliseconds. The writes
+    run on a single writer thread, so batches of the same session stay in
+    order and the IOLoop never waits on the disk. Storage files stay open
+    until the session is finished.
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tc-writer")
+    _open = set()   # storages with open files, only used from the writer thread
+    _dirty = set()  # storages written since the last sync, writer thread
+    _finished = []  # storages closed for good since the last sync, writer thread
+    _buffers = {}   # storage -> list of pending (ts, value) rows
+    _buffered = 0
+    _callback = None
+
+    _flushes = 0
+    _rows_written = 0
+    _bytes_written = 0
+    _last_flush_ms = 0.0
+    _max_flush_ms = 0.0
+
+    @classmethod
+    def start(cls) -> None:
+        if cls._callback is None:
+            cls._callback = PeriodicCallback(cls.flush, FLUSH_MS)
+            cls._callback.start()
+
+    @classmethod
+    def append(cls, storage, ts: int, value: int) -> None:
+        buf = cls._buffers.get(storage)
+        if buf is None:
+            buf = cls._buffers[storage] = []
+        buf.append((ts, value))
+        cls._buffered += 1
+        if cls._buffered >= FLUSH_ROWS:
+            cls.flush()
+
+    @classmethod
+    def extend(cls, storage, rows: list) -> None:
+        buf = cls._buffers.get(storage)
+        if buf is None:
+            buf = cls._buffers[storage] = []
+        buf.extend(rows)
+        cls._buffered += len(rows)
+        if cls._buffered >= FLUSH_ROWS:
+            cls.flush()
+
+    @classmethod
+    def _take(cls, storage=None) -> dict:
+        if storage:
+            rows = cls._buffers.pop(storage, None)
+            batches = {storage: rows} if rows else {}
+        else:
+            batches, cls._buffers = cls._buffers, {}
+        cls._buffered -= sum(len(rows) for rows in batches.values())
+        return batches
+
+    @classmethod
+    def _write(cls, batches: dict, close=()) -> None:
+        """Writer thread: append the batches, then close the given storages
+        (every open storage if close is None)"""
+        t0 = perf_counter()
+        written = 0
+        for storage, rows in batches.items():
+            cls._open.add(storage)
+            try:
+                size = storage.append(rows)
+            except Exception as e:
+                # one broken storage must not lose the other sessions' rows
+                log("error", f"Writer: {len(rows)} rows to {storage.path} lost: {e!r}")
+                continue
+            cls._bytes_written += size
+            WRITER_BYTES.inc((storage.name,), size)
+            cls._dirty.add(storage)
+            written += len(rows)
+        for storage in list(cls._open) if close is None else close:
+            storage.close()
+            cls._open.discard(storage)
+        if close:
+            cls._finished.extend(close)
+        if written:
+            cls._rows_written += written
+            cls._flushes += 1
+            cls._last_flush_ms = (perf_counter() - t0) * 1000
+            WRITER_FLUSH.observe(cls._last_flush_ms / 1000)
+            cls._max_flush_ms = max(cls._max_flush_ms, cls._last_flush_ms)
+
+    @classmethod
+    def _submit(cls, batches: dict, close=()):
+        return IOLoop.current().run_in_executor(cls._executor, cls._write, batches, close)
+
+    @classmethod
+    def flush(cls, storage=None):
+        """Write pending rows of one storage, or of every storage if None"""
+        return cls._submit(cls._take(storage))
+
+    @classmethod
+    def close(cls, storage):
+        """Flush and close one storage"""
+        return cls._submit(cls._take(storage), close=(storage,))
+
+    @classmethod
+    def _sync(cls, batches: dict):
+        """Writer thread: append the batches and fsync every storage written
+        since the last sync. Returns the positions of those storages and the
+        finished ones, together they hold every row taken so far."""
+        cls._write(batches)
+        positions = {}
+        for storage in cls._dirty:
+            storage.sync()
+            positions[WAL.key(storage)] = storage.position()
+        finished = [WAL.key(storage) for storage in cls._finished]
+        cls._dirty = set()
+        cls._finished = []
+        return positions, finished
+
+    @classmethod
+    def sync(cls):
+        """Write pending rows and make them durable, see _sync"""
+        return IOLoop.current().run_in_executor(cls._executor, cls._sync, cls._take())
+
+    @classmethod
+    def stop(cls):
+        """Flush and close every storage"""
+        if cls._callback:
+            cls._callback.stop()
+            cls._callback = None
+        return cls._submit(cls._take(), close=None)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "buffered_rows": cls._buffered,
+            "open_files": len(cls._open),
+            "flushes": cls._flushes,
+            "rows_written": cls._rows_written,
+            "bytes_written": cls._bytes_written,
+            "last_flush_ms": round(cls._last_flush_ms, 3),
+            "max_flush_ms": round(cls._max_flush_ms, 3)
+        }
+
+#######
+# WAL #
+#######
+
+# Samples are appended to a write-ahead log before they reach the
+# SessionWriter. The log is written and fsynced by its own thread every
+# WAL_SYNC_MS or WAL_SYNC_ROWS rows (group commit), so a crash loses at most
+# that window instead of everything still buffered or in the page cache.
+# A checkpoint every WAL_CHECKPOINT seconds fsyncs the session storages and
+# deletes the log segments they cover; checkpoint.json keeps each storage's
+# position at that point, and replay appends only the rows a storage lacks.
+
+class WAL:
+
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tc-wal")
+    _lines = []       # encoded records not yet handed to the WAL thread
+    _rows = 0
+    _segment = 0      # segment new records go to
+    _file = None      # open segment, WAL thread
+    _file_segment = None
+    _positions = {}   # storage key -> position at the last checkpoint, WAL thread
+    _callbacks = []
+    _checkpointing = False
+
+    _commits = 0
+    _rows_logged = 0
+    _bytes_logged = 0
+    _last_commit_ms = 0.0
+    _checkpoints = 0
+    _replayed = 0
+
+    @staticmethod
+    def key(storage) -> str:
+        return f"{storage.name}:{storage.path}"
+
+    @staticmethod
+    def _path(n: int) -> str:
+        return f"{WAL_DIR}/{n:08d}.wal"
+
+    @staticmethod
+    def _checkpoint_file() -> str:
+        return f"{WAL_DIR}/checkpoint.json"
+
+    @staticmethod
+    def _segments() -> list:
+        return sorted(int(f[:-4]) for f in os.listdir(WAL_DIR) if f.endswith('.wal'))
+
+    @classmethod
+    def append(cls, storage, rows) -> None:
+        """Logs (ts, value) rows of a storage, call before handing them to
+        the SessionWriter"""
+        if not WAL_ENABLED:
+            return
+        cls._lines.append(json.dumps([cls.key(storage), rows], separators=(',', ':')))
+        cls._rows += len(rows)
+        if cls._rows >= WAL_SYNC_ROWS:
+            cls.commit()
+
+    @classmethod
+    def _write(cls, segment: int, lines: list) -> None:
+        """WAL thread: append the records to the segment and fsync it"""
+        if not lines:
+            return
+        t0 = perf_counter()
+        if cls._file_segment != segment:
+            if cls._file:
+                cls._file.close()
+            cls._file = open(cls._path(segment), 'a')
+            cls._file_segment = segment
+        data = '\n'.join(lines) + '\n'
+        cls._file.write(data)
+        cls._file.flush()
+        os.fsync(cls._file.fileno())
+        cls._commits += 1
+        cls._bytes_logged += len(data)
+        cls._last_commit_ms = (perf_counter() - t0) * 1000
+        WAL_COMMIT.observe(cls._last_commit_ms / 1000)
+
+    @classmethod
+    def commit(cls):
+        """Group commit of the pending records"""
+        lines, cls._lines = cls._lines, []
+        cls._rows_logged += cls._rows
+        cls._rows = 0
+        return IOLoop.current().run_in_executor(cls._executor, cls._write, cls._segment, lines)
+
+    @classmethod
+    def _retire(cls, segment: int, positions: dict, finished: list) -> None:
+        """WAL thread: record the checkpoint, then drop the segments up to
+        segment, the storages hold their rows"""
+        cls._positions.update(positions)
+        for key in finished:
+            cls._positions.pop(key, None)
+        replace_json(cls._checkpoint_file(), {"segment": segment + 1, "positions": cls._positions})
+        if cls._file_segment is not None and cls._file_segment <= segment:
+            cls._file.close()
+            cls._file = None
+            cls._file_segment = None
+        for n in cls._segments():
+            if n <= segment:
+                os.remove(cls._path(n))
+        cls._checkpoints += 1
+
+    @classmethod
+    async def checkpoint(cls) -> None:
+        if not WAL_ENABLED or cls._checkpointing:
+            return
+        cls._checkpointing = True
+        try:
+            # the segment switch and the writer snapshot happen in the same
+            # IOLoop step, so the old segments hold exactly the synced rows
+            segment = cls._segment
+            committed = cls.commit()
+            cls._segment += 1
+            synced = SessionWriter.sync()
+            await committed
+            positions, finished = await synced
+            await IOLoop.current().run_in_executor(cls._executor, cls._retire,
+                segment, positions, finished)
+        finally:
+            cls._checkpointing = False
+
+    @classmethod
+    def replay(cls) -> int:
+        """Appends the logged rows the storages lost in a crash, then
+        checkpoints. Blocking, runs in main() before the IOLoop."""
+        os.makedirs(WAL_DIR, exist_ok=True)
+        state = read_json(cls._checkpoint_file())
+        cls._positions = state.get('positions', {})
+        segments = cls._segments()
+        pending = {}
+        for n in segments:
+            with open(cls._path(n), 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # torn by the crash, was never committed
+                    key, rows = json.loads(line)
+                    pending.setdefault(key, []).extend(rows)
+
+        replayed = 0
+        for key, rows in pending.items():
+            kind, path = key.split(':', 1)
+            storage = STORAGES[kind](path)
+            if not storage.exists():
+                continue  # removed after the rows were logged
+            try:
+                missing = rows[storage.recover(cls._positions.get(key)):]
+                if missing:
+                    storage.append([(ts, value) for ts, value in missing])
+                    replayed += len(missing)
+                storage.sync()
+                cls._positions[key] = storage.position()
+            except Exception as e:
+                log("error", f"WAL: replay into {path} failed: {e!r}")
+            finally:
+                storage.close()
+
+        cls._segment = segments[-1] + 1 if segments else state.get('segment', 0)
+        replace_json(cls._checkpoint_file(), {"segment": cls._segment, "positions": cls._positions})
+        for n in segments:
+            os.remove(cls._path(n))
+        cls._replayed = replayed
+        if replayed:
+            log("alert", f"WAL: {replayed} rows replayed into session storage")
+        return replayed
+
+    @classmethod
+    def start(cls) -> None:
+        if WAL_ENABLED and not cls._callbacks:
+            cls._callbacks = [
+                PeriodicCallback(lambda: cls._lines and cls.commit(), WAL_SYNC_MS),
+                PeriodicCallback(cls.checkpoint, WAL_CHECKPOINT * 1000)
+            ]
+            for callback in cls._callbacks:
+                callback.start()
+
+    @classmethod
+    async def stop(cls) -> None:
+        """Last checkpoint, nothing is left to replay after a clean stop"""
+        for callback in cls._callbacks:
+            callback.stop()
+        cls._callbacks = []
+        while cls._checkpointing:
+            await gen.sleep(0.05)
+        await cls.checkpoint()
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "enabled": WAL_ENABLED,
+            "pending_rows": cls._rows,
+            "segment": cls._segment,
+            "commits": cls._commits,
+            "rows_logged": cls._rows_logged,
+            "bytes_logged": cls._bytes_logged,
+            "last_commit_ms": round(cls._last_commit_ms, 3),
+            "checkpoints": cls._checkpoints,
+            "replayed_rows": cls._replayed
+        }
+
+##########
+# Rollup #
+##########
+
+class Rollup:
+    """Running statistics of one session per minute, hour and day.
+
+    Every bucket is [count, sum, min, max, sum of squares], updated in O(1)
+    on each sample, so summaries cost O(buckets) instead of a scan of the
+    raw data. Buckets start at local minute, hour and day boundaries. Dirty
+    rollups are saved next to the session data every ROLLUP_SAVE_MS, with
+    the newest timestamp they cover so a restart can add the stored rows
+    written after the last save (see catch_up).
+    """
+
+    LEVELS = ('minute', 'hour', 'day')
+    RETENTION = {"minute": ROLLUP_MINUTES, "hour": ROLLUP_HOURS, "day": None}
+
+    _live = {}      # session id -> Rollup of running sessions
+    _dirty = set()
+    _callback = None
+
+    def __init__(self, sid: str, path: str):
+        self.sid = sid
+        self.path = path
+        self.buckets = {level: {} for level in self.LEVELS}
+        self._current = {}   # level -> (key, bucket)
+        self._hour = None
+        self._offset = 0
+        self.until = None    # newest ts added
+        self.at_until = 0    # rows added with ts == until
+
+    @classmethod
+    def start(cls) -> None:
+        if cls._callback is None:
+            cls._callback = PeriodicCallback(cls.save_dirty, ROLLUP_SAVE_MS)
+            cls._callback.start()
+
+    @classmethod
+    def register(cls, rollup) -> None:
+        cls._live[rollup.sid] = rollup
+
+    @classmethod
+    def unregister(cls, sid: str) -> None:
+        rollup = cls._live.pop(sid, None)
+        cls._dirty.discard(rollup)
+
+    @classmethod
+    def get(cls, sid: str):
+        return cls._live.get(sid)
+
+    @classmethod
+    def live_totals(cls) -> dict:
+        """Totals of every running session, by session id"""
+        return {sid: rollup.totals() for sid, rollup in cls._live.items()}
+
+    @classmethod
+    def save_dirty(cls):
+        dirty, cls._dirty = cls._dirty, set()
+        snapshots = [(r.path, r.snapshot()) for r in dirty]
+        return run_io(cls._save_all, snapshots)
+
+    @staticmethod
+    def _save_all(snapshots: list) -> None:
+        for path, data in snapshots:
+            if os.path.isdir(os.path.dirname(path)):
+                replace_json(path, data)
+
+    def _keys(self, ts: int) -> tuple:
+        hour = ts - ts % 3600
+        if hour != self._hour:
+            # utc offset only changes on hour boundaries (DST)
+            self._hour = hour
+            self._offset = localtime(ts).tm_gmtoff
+        minute = ts - (ts + self._offset) % 60
+        return minute, ts - (ts + self._offset) % 3600, ts - (ts + self._offset) % 86400
+
+    def add(self, ts: int, value) -> None:
+        for level, key in zip(self.LEVELS, self._keys(ts)):
+            current = self._current.get(level)
+            if current is None or current[0] != key:
+                buckets = self.buckets[level]
+                b = buckets.get(key)
+                if b is None:
+                    b = buckets[key] = [0, 0, value, value, 0]
+                    limit = self.RETENTION[level]
+                    if limit and len(buckets) > limit:
+                        buckets.pop(next(iter(buckets)))
+                current = self._current[level] = (key, b)
+            b = current[1]
+            b[0] += 1
+            b[1] += value
+            if value < b[2]:
+                b[2] = value
+            elif value > b[3]:
+                b[3] = value
+            b[4] += value * value
+        if self.until is None or ts > self.until:
+            self.until = ts
+            self.at_until = 1
+        elif ts == self.until:
+            self.at_until += 1
+        Rollup._dirty.add(self)
+
+    def snapshot(self) -> dict:
+        data = {level: {str(k): list(b) for k, b in self.buckets[level].items()}
+            for level in self.LEVELS}
+        data['until'] = self.until
+        data['at_until'] = self.at_until
+        return data
+
+    @classmethod
+    def load(cls, sid: str, path: str):
+        """Rollup saved by a previous run, empty if there is none"""
+        rollup = cls(sid, path)
+        data = read_json(path)
+        for level in cls.LEVELS:
+            rollup.buckets[level] = {int(k): b for k, b in data.get(level, {}).items()}
+        rollup.until = data.get('until')
+        rollup.at_until = data.get('at_until', 0)
+        return rollup
+
+    def catch_up(self, storage) -> int:
+        """Adds the stored rows after the covered ones: rows written after
+        the last save or replayed from the WAL by a crash. Rollups saved
+        without 'until' are left as they are. Returns the rows added."""
+        if (self.until is None and self.buckets['day']) or not storage.exists():
+            return 0
+        until, skip = self.until, self.at_until
+        added = 0
+        minute = base = None
+        for lines in storage.iter_lines(start=until):
+            for line in lines:
+                if line[:16] != minute:
+                    minute = line[:16]
+                    base = _parse_ts(f"{minute}:00")
+                ts = base + int(line[17:19])
+                if ts == until and skip:
+                    skip -= 1
+                    continue
+                self.add(ts, int(line[20:]))
+                added += 1
+        return added
+
+    def save(self) -> None:
+        replace_json(self.path, self.snapshot())
+
+    def remove(self) -> None:
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def _stats(b: list) -> dict:
+        count, total, vmin, vmax, sq = b
+        mean = total / count
+        return {
+            "count": count,
+            "mean": round(mean, 3),
+            "min": vmin,
+            "max": vmax,
+            "std": round(max(sq / count - mean * mean, 0) ** 0.5, 3)
+        }
+
+    def totals(self) -> dict:
+        """Whole session statistics, merged from the day buckets"""
+        days = list(self.buckets['day'].values())
+        if not days:
+            return {"count": 0}
+        merged = [
+            sum(b[0] for b in days),
+            sum(b[1] for b in days),
+            min(b[2] for b in days),
+            max(b[3] for b in days),
+            sum(b[4] for b in days)
+        ]
+        return self._stats(merged)
+
+    def summary(self, level='hour', start=None, end=None) -> list:
+        """Statistics per bucket of a level with start <= bucket < end"""
+        out = []
+        fmt = _ts_formatter()
+        for key, b in sorted(self.buckets[level].items()):
+            if (start is not None and key < start) or (end is not None and key >= end):
+                continue
+            d = {"time": fmt(key)}
+            d.update(self._stats(b))
+            out.append(d)
+        return out
+
+
+#############
+# Scheduler #
+#############
+
+class Scheduler:
+    """Polls the boards of interval sessions from the IOLoop.
+
+    A heap of (due, seq, session id) drives a single IOLoop timeout set for
+    the earliest due time. When it fires, every session due within
+    COALESCE_MS is popped and grouped by (board, sensor), so sessions on the
+    same sensor share one board request. A board never has more than
+    BOARD_CONCURRENCY requests in flight, polls beyond that are skipped.
+    """
+
+    _heap = []
+    _seq = count()
+    _sessions = {}   # id -> (session, period in seconds)
+    _inflight = {}   # board id -> requests in flight
+    _timer = None
+    _timer_due = None
+
+    _polls = 0
+    _errors = 0
+    _skipped = 0
+    _coalesced = 0
+
+    @staticmethod
+    def check(interval_type, interval) -> float:
+        """Period in seconds, ValueError unless interval_type is one of
+        INTERVALS and interval a positive number"""
+        if not isinstance(interval_type, str) or interval_type not in INTERVALS:
+            raise ValueError(f"interval_type must be one of {', '.join(INTERVALS)}")
+        try:
+            period = float(interval) if not isinstance(interval, bool) else 0.0
+        except (TypeError, ValueError):
+            period = 0.0
+        if not 0 < period < float('inf'):
+            raise ValueError(f"interval must be a positive number, got {interval!r}")
+        return INTERVALS[interval_type] * period
+
+    @staticmethod
+    def period(session) -> float:
+        return INTERVALS[session.interval_type] * float(session.interval)
+
+    @classmethod
+    def add(cls, session) -> None:
+        """Poll the session every interval, starting now. A session already
+        polled keeps its schedule."""
+        if session.id in cls._sessions:
+            return
+        cls._sessions[session.id] = (session, cls.period(session))
+        cls._push(IOLoop.current().time(), session.id)
+        cls._schedule()
+
+    @classmethod
+    def remove(cls, sid: str) -> None:
+        # heap entries of removed sessions are dropped when they come up
+        cls._sessions.pop(sid, None)
+
+    @classmethod
+    def _push(cls, due: float, sid: str) -> None:
+        heappush(cls._heap, (due, next(cls._seq), sid))
+
+    @classmethod
+    def _schedule(cls) -> None:
+        if not cls._heap:
+            return
+        due = cls._heap[0][0]
+        if cls._timer is not None:
+            if cls._timer_due <= due:
+                return
+            IOLoop.current().remove_timeout(cls._timer)
+        cls._timer_due = due
+        cls._timer = IOLoop.current().call_at(due, cls._run)
+
+    @classmethod
+    def _run(cls) -> None:
+        cls._timer = None
+        loop = IOLoop.current()
+        now = loop.time()
+        limit = now + COALESCE_MS / 1000
+        groups = {}
+        while cls._heap and cls._heap[0][0] <= limit:
+            due, _, sid = heappop(cls._heap)
+            entry = cls._sessions.get(sid)
+            if entry is None:
+                continue
+            session, period = entry
+            groups.setdefault((session.board, session.sensor), []).append(session)
+            # fixed rate, missed periods are skipped rather than replayed
+            due += period
+            if due <= now:
+                due += period * ((now - due) // period + 1)
+            cls._push(due, sid)
+        for key, sessions in groups.items():
+            cls._coalesced += len(sessions) - 1
+            loop.spawn_callback(cls._poll, key[0], key[1], sessions)
+        cls._schedule()
+
+    @classmethod
+    async def _poll(cls, board_id: str, sensor: str, sessions: list) -> None:
+        board = BOARDS.get(board_id)
+        if board is None:
+            return
+        if cls._inflight.get(board_id, 0) >= BOARD_CONCURRENCY:
+            cls._skipped += 1
+            return
+        cls._inflight[board_id] = cls._inflight.get(board_id, 0) + 1
+        cls._polls += 1
+        try:
+            value = await board.get_data(sensor)
+        except Exception:
+            cls._errors += 1
+            return
+        finally:
+            cls._inflight[board_id] -= 1
+        if value is None:
+            return
+        ts = int(time())
+        for session in sessions:
+            if session.active:
+                session.write(value, ts)
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "sessions": len(cls._sessions),
+            "polls": cls._polls,
+            "errors": cls._errors,
+            "skipped": cls._skipped,
+            "coalesced": cls._coalesced
+        }
 
 
 ##################
@@ -245,32 +1895,299 @@ class CronTab:
 ##################
 
 class SessionManager:
+    """In-memory index of every session, the only owner of sessions.json.
+
+    Active and inactive sessions are kept by id in one dict per state and
+    every session is indexed by (board, sensor). Finished sessions leave
+    memory: their records are appended to the archive file (json lines) and
+    only their offset is kept, so a long-running service holding thousands
+    of finished sessions stays small. Changes only mark the index dirty; the
+    archive and sessions.json are written at most once every SAVE_DELAY
+    seconds, in a worker thread, sessions.json through a temp file and a
+    rename so a crash never leaves a truncated file.
+    """
     
-    _sessions_file = ""
+    _sessions_file = SESS_FIL
+    _archive_file = f"{SESS_DIR}/archive.jsonl"
     
     _active_sessions = {}
     _inactive_sessions = {}
-    _finished_sessions = {}
+
+    _state = {}      # id -> state name
+    _by_sensor = {}  # (board, sensor) -> set of ids
+    _archived = {}   # id -> (archive file, offset) of finished sessions
+    _unwritten = {}  # id -> finished record not in the archive file yet
+    _archive_queue = deque()  # (id, record, line) waiting to be appended
+    _archive_size = 0
+    _scanned = {}    # archive file -> bytes read by load_sessions
+
+    _timer = None
+    _generation = 0
+    _saved_generation = 0
+    _save_lock = Lock()
 
     @classmethod
-    def new_session(cls):
-        pass
+    def _states(cls) -> dict:
+        return {
+            "active": cls._active_sessions,
+            "inactive": cls._inactive_sessions
+        }
+
+    @staticmethod
+    def _state_of(session: dict) -> str:
+        if session['finished']:
+            return 'finished'
+        return 'active' if session['active'] else 'inactive'
 
     @classmethod
-    def remove_session(cls):
-        pass
+    def _index(cls, state: str, session: dict) -> None:
+        sid = session['id']
+        old = cls._state.get(sid)
+        if old and old != state and old != 'finished':
+            cls._states()[old].pop(sid)
+        if state == 'finished':
+            cls._archive(session)
+        else:
+            cls._states()[state][sid] = session
+        cls._state[sid] = state
+        cls._by_sensor.setdefault((session['board'], session['sensor']), set()).add(sid)
 
     @classmethod
-    def list_sessions(cls):
-        pass
+    def _archive(cls, record: dict) -> None:
+        """Queue a finished record (or a removal) for the archive file"""
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+        sid = record['id']
+        if record.get('removed'):
+            cls._archived.pop(sid, None)
+            cls._unwritten.pop(sid, None)
+        else:
+            cls._archived[sid] = (cls._archive_file, cls._archive_size)
+            cls._unwritten[sid] = record
+        cls._archive_queue.append((sid, record, line))
+        cls._archive_size += len(line)
 
     @classmethod
-    def load_sessions(cls):
-        pass
+    def new_session(cls, session: dict) -> None:
+        """Add a session record"""
+        cls.update_session(session)
 
     @classmethod
-    def save_sessions(cls):
-        pass
+    def update_session(cls, session: dict) -> None:
+        """Add or replace a session record, moving it to its current state"""
+        cls._index(cls._state_of(session), session)
+        cls._changed()
+
+    @classmethod
+    def remove_session(cls, sid: str) -> None:
+        state = cls._state.pop(sid, None)
+        if state is None:
+            return
+        if state == 'finished':
+            key = next(key for key, ids in cls._by_sensor.items() if sid in ids)
+            cls._archive({"id": sid, "board": key[0], "sensor": key[1], "removed": True})
+        else:
+            session = cls._states()[state].pop(sid)
+            key = (session['board'], session['sensor'])
+        ids = cls._by_sensor.get(key)
+        if ids:
+            ids.discard(sid)
+        cls._changed()
+
+    @classmethod
+    def exists(cls, sid: str) -> bool:
+        return sid in cls._state
+
+    @classmethod
+    async def get_session(cls, sid: str) -> dict:
+        state = cls._state.get(sid)
+        if state == 'finished':
+            # one seek into the archive
+            return (await cls._read_archived([sid]))[sid]
+        return cls._states()[state][sid] if state else None
+
+    @classmethod
+    async def _read_archived(cls, ids) -> dict:
+        """Records of finished sessions, the archive is read in an I/O
+        thread"""
+        records = {}
+        by_file = {}
+        for sid in ids:
+            if sid in cls._unwritten:
+                records[sid] = cls._unwritten[sid]
+            else:
+                fp, offset = cls._archived[sid]
+                by_file.setdefault(fp, []).append((offset, sid))
+        if by_file:
+            records.update(await run_io(cls._read_offsets, by_file))
+        return records
+
+    @staticmethod
+    def _read_offsets(by_file: dict) -> dict:
+        records = {}
+        for fp, entries in by_file.items():
+            with open(fp, 'rb') as f:
+                for offset, sid in sorted(entries):
+                    f.seek(offset)
+                    records[sid] = json.loads(f.readline())
+        return records
+
+    @classmethod
+    async def list_sessions(cls, board=None, sensor=None, session=None) -> dict:
+        """Sessions grouped by state, optionally filtered"""
+        if session:
+            ids = [session] if session in cls._state else []
+        elif board and sensor:
+            ids = cls._by_sensor.get((board, sensor), ())
+        elif board:
+            ids = [i for (b, _), s in cls._by_sensor.items() if b == board for i in s]
+        else:
+            ids = cls._state
+
+        sessions = {"active": {}, "inactive": {}, "finished": {}}
+        finished = []
+        for sid in ids:
+            state = cls._state[sid]
+            if state == 'finished':
+                finished.append(sid)
+            else:
+                sessions[state][sid] = cls._states()[state][sid]
+        if finished:
+            records = await cls._read_archived(finished)
+            sessions['finished'] = {sid: records[sid] for sid in finished}
+        return sessions
+
+    @classmethod
+    def load_sessions(cls, snapshot=None) -> None:
+        """Build the index from the archive and sessions.json, once at
+        startup. With --workers every worker's files are read, newest last,
+        keeping the sessions of the boards this worker owns. Finished
+        sessions of older sessions.json files move to the archive.
+
+        snapshot is a previous archive_index(): its finished sessions are
+        taken as they are and only the archive lines after it are read."""
+        archives, files = [cls._archive_file], [cls._sessions_file]
+        if WORKERS > 1:
+            archives = sorted(glob(f"{SESS_DIR}/archive*.jsonl"), key=os.path.getmtime)
+            files = sorted(glob(f"{SESS_DIR}/sessions*.json"), key=os.path.getmtime)
+        read = (snapshot or {}).get('archives', {})
+        if any(not os.path.isfile(fp) or os.path.getsize(fp) < size for fp, size in read.items()):
+            read = {}  # an archive was replaced, read everything
+        elif read:
+            for sid, (fp, offset, board, sensor) in snapshot['finished'].items():
+                cls._state[sid] = 'finished'
+                cls._archived[sid] = (fp, offset)
+                cls._by_sensor.setdefault((board, sensor), set()).add(sid)
+        for fp in archives:
+            if not os.path.isfile(fp):
+                continue
+            with open(fp, 'rb') as f:
+                offset = f.seek(read.get(fp, 0))
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # torn by a crash while appending
+                    record = json.loads(line)
+                    sid = record['id']
+                    key = (record['board'], record['sensor'])
+                    if record.get('removed'):
+                        if cls._state.pop(sid, None):
+                            cls._archived.pop(sid, None)
+                            cls._by_sensor[key].discard(sid)
+                    elif owner(record['board']) == WORKER:
+                        cls._state[sid] = 'finished'
+                        cls._archived[sid] = (fp, offset)
+                        cls._by_sensor.setdefault(key, set()).add(sid)
+                    offset += len(line)
+            cls._scanned[fp] = offset
+            if fp == cls._archive_file and offset < os.path.getsize(fp):
+                # later records are appended after the last whole one
+                os.truncate(fp, offset)
+        if os.path.isfile(cls._archive_file):
+            cls._archive_size = os.path.getsize(cls._archive_file)
+
+        for fp in files:
+            data = read_json(fp)
+            for state in ("active", "inactive", "finished"):
+                for session in data.get(state, {}).values():
+                    # archived while this sessions.json was not rewritten yet
+                    if session['id'] in cls._archived:
+                        continue
+                    if owner(session['board']) == WORKER:
+                        cls._index(state, session)
+        if cls._archive_queue or not os.path.isfile(cls._sessions_file):
+            cls.save_sessions()
+
+    @classmethod
+    def unfinished(cls) -> list:
+        """Records of the running and waiting sessions"""
+        return [*cls._active_sessions.values(), *cls._inactive_sessions.values()]
+
+    @classmethod
+    def archive_index(cls) -> dict:
+        """Finished sessions by id as [archive file, offset, board, sensor]
+        and the bytes of each archive file they cover. Only meaningful with
+        the archive queue written, at startup and on stop."""
+        finished = {}
+        for (board, sensor), ids in cls._by_sensor.items():
+            for sid in ids:
+                if cls._state.get(sid) == 'finished':
+                    fp, offset = cls._archived[sid]
+                    finished[sid] = [fp, offset, board, sensor]
+        archives = dict(cls._scanned)
+        archives[cls._archive_file] = cls._archive_size
+        return {"archives": archives, "finished": finished}
+
+    @classmethod
+    def save_sessions(cls) -> None:
+        """Write the archive and sessions.json now (blocking)"""
+        cls._generation += 1
+        cls._write(cls._generation, {k: dict(v) for k, v in cls._states().items()})
+
+    @classmethod
+    def _write(cls, generation: int, sessions: dict) -> None:
+        with cls._save_lock:
+            t0 = perf_counter()
+            # finished records are archived before sessions.json drops them,
+            # in queue order as their offsets were given out in that order
+            queued = []
+            while cls._archive_queue:
+                queued.append(cls._archive_queue.popleft())
+            if queued:
+                with open(cls._archive_file, 'ab') as f:
+                    f.writelines(line for _, _, line in queued)
+                    f.flush()
+                    os.fsync(f.fileno())
+                for sid, record, _ in queued:
+                    if cls._unwritten.get(sid) is record:
+                        cls._unwritten.pop(sid, None)
+            # a newer snapshot may already be on disk
+            if generation > cls._saved_generation:
+                replace_json(cls._sessions_file, sessions)
+                cls._saved_generation = generation
+            SESSIONS_SAVE.observe(perf_counter() - t0)
+
+    @classmethod
+    def _changed(cls) -> None:
+        cls._generation += 1
+        if cls._timer is None:
+            cls._timer = IOLoop.current().call_later(SAVE_DELAY, cls._save_later)
+
+    @classmethod
+    def _save_later(cls):
+        cls._timer = None
+        # records are replaced, never mutated, so shallow copies are safe
+        # to serialize in the worker thread
+        sessions = {k: dict(v) for k, v in cls._states().items()}
+        return run_io(cls._write, cls._generation, sessions)
+
+    @classmethod
+    async def stop(cls) -> None:
+        """Write pending changes and stop the write-behind timer"""
+        if cls._timer is not None:
+            IOLoop.current().remove_timeout(cls._timer)
+            cls._timer = None
+        if cls._generation > cls._saved_generation or cls._archive_queue:
+            await run_io(cls._write, cls._generation,
+                {k: dict(v) for k, v in cls._states().items()})
 
 #########
 # Board #
@@ -278,16 +2195,34 @@ class SessionManager:
 
 class Board:
 
+    __slots__ = ('id', 'ip', 'connection_date', 'sensors', 'url', 'on_change_events',
+        'sessions', 'ws_connection')
+
     class Session:
 
+        __slots__ = ('id', 'board', 'sensor', 'type', 'description', 'interval_type', 'interval',
+            'start_date', 'finish_date', 'alert', 'finished', 'min_value', 'max_value', 'rules',
+            '_start_job', '_finish_job', 'active', 'folder', 'storage', 'file', 'rollup')
+
         _session_url = f'http://localhost:8000/session'
+        _issued = set()  # ids given out by this process in _issued_date
+        _issued_date = None
         
         def __init__(self, board, sensor, description, stype=None, interval_type=None, interval=None,
             start_date=None, finish_date=None,
-            alert=False, min_value=None, max_value=None):
+            alert=False, min_value=None, max_value=None, rules=None):
 
             date = datetime.now().strftime('%y%m%d%H%M%S')
-            self.id = f"{date}"
+            if WORKERS > 1:
+                date = f"{date}-w{WORKER}"
+            # sessions created within the same second get a suffix
+            if date != Board.Session._issued_date:
+                Board.Session._issued_date, Board.Session._issued = date, set()
+            sid, n = date, 1
+            while sid in self._issued or SessionManager.exists(sid):
+                sid, n = f"{date}-{n}", n + 1
+            self._issued.add(sid)
+            self.id = sid
             self.board = board
             self.sensor = sensor
             self.type = stype # open or scheduled
@@ -300,81 +2235,118 @@ class Board:
             self.finished = False
             self.min_value = min_value
             self.max_value = max_value
+            # compiled by Rules.compile, the range rule comes from min and max
+            self.rules = list(rules or ())
+            if alert and is_number(min_value) and is_number(max_value):
+                self.rules.insert(0, RangeRule(min_value, max_value))
             self._start_job = None
             self._finish_job = None
-            self._data_job = None
             self.active = False
             self.folder = f"{SESS_DIR}/{board}_{sensor}"
-            self.file = f"{self.folder}/{description}_{date}.csv"
-
-            if not os.path.isdir(self.folder):
-                os.makedirs(self.folder)
-            
-            if not os.path.isfile(self.file):
-                with open(self.file, 'w+') as f:
-                    f.write('TimeStamp,Value\n')
+            self.storage = open_storage(STORAGE, f"{self.folder}/{description}_{self.id}")
+            self.file = self.storage.path
+            self.rollup = Rollup(self.id, f"{self.file}.rollup.json")
+            Rollup.register(self.rollup)
 
             if start_date:
-                command = f'curl "{self._session_url}/action/start?board={board}&sensor={sensor}&session={date}"'
+                command = f'curl "{self._session_url}/action/start?board={board}&sensor={sensor}&session={self.id}"'
                 job = CronTab.new_job(command)
                 job.month = int(start_date.split('-')[1])
                 job.day = int(start_date.split('-')[2])
                 self._start_job = job
 
             if finish_date:
-                command = f'curl "{self._session_url}/action/finish?board={board}&sensor={sensor}&session={date}"'
+                command = f'curl "{self._session_url}/action/finish?board={board}&sensor={sensor}&session={self.id}"'
                 job = CronTab.new_job(command)
                 job.month = int(finish_date.split('-')[1])
                 job.day = int(finish_date.split('-')[2])
                 self._finish_job = job
-                
-            if start_date or finish_date:
-                CronTab.write()
 
+        @classmethod
+        def restore(cls, record: dict):
+            """Session of a sessions.json record, at startup. Its files and
+            cron jobs already exist, its rollups are loaded from disk."""
+            self = cls.__new__(cls)
+            alert = record['alert']
+            self.id = record['id']
+            self.board = record['board']
+            self.sensor = record['sensor']
+            self.type = record['type']
+            self.description = record['description']
+            self.interval_type = record['interval_type']
+            self.interval = record['interval']
+            self.start_date = record['start_date']
+            self.finish_date = record['finish_date']
+            self.alert = alert['status']
+            self.finished = False
+            self.min_value = alert['min_value']
+            self.max_value = alert['max_value']
+            self.rules = Rules.compile(alert.get('rules') or [], self.board)
+            if self.description == 'interval':
+                Scheduler.check(self.interval_type, self.interval)
+            if self.alert and is_number(self.min_value) and is_number(self.max_value):
+                self.rules.insert(0, RangeRule(self.min_value, self.max_value))
+            self._start_job = None
+            self._finish_job = None
+            self.active = record['active']
+            self.storage = session_storage(record)
+            self.file = self.storage.path
+            self.folder = os.path.dirname(self.file)
+            self.rollup = Rollup.load(self.id, f"{self.file}.rollup.json")
+            try:
+                self.rollup.catch_up(self.storage)
+            except (OSError, ImportError, ValueError) as e:
+                log("error", f"Session {self.id}: rollup not caught up: {e!r}", board=self.board)
+            Rollup.register(self.rollup)
+            return self
+
+        async def create(self) -> None:
+            """Create the session file, install its cron jobs and save it"""
+            await run_io(self._create_file)
+            if self._start_job or self._finish_job:
+                await run_io(CronTab.write)
             self.save_session()
 
-        def start(self, url=None) -> None:
+        def _create_file(self) -> None:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            self.storage.create()
+
+        async def start(self) -> None:
             self.active = True
             if self.description == 'interval':
-                command = f'curl "{url}?board={self.board}&sensor={self.sensor}&session={self.id}"'
-                job = CronTab.new_job(command)
-                job.every(self.interval_type, self.interval)
-                self._data_job = job
-                CronTab.write()
-            sessions = read_json(SESS_FIL)
-            if self.id in sessions['inactive'].keys():
-                sessions['inactive'].pop(self.id)
-            write_json(SESS_FIL, sessions)
+                Scheduler.add(self)
+            Rules.watch(self)
             self.save_session()
 
-        def finish(self, clean=False) -> None:
+        async def finish(self, clean=False) -> None:
+            """Stops the session and drops it from memory, its record
+            moves to the SessionManager archive"""
             self.active = False
             self.finished = True
             board = BOARDS[self.board]
             sensor = board.sensors[self.sensor]
             if self.description == 'interval':
-                sensor.interval_sessions.remove(self)
-                CronTab.remove_job(self._data_job.command)
-            else:
+                sensor.interval_sessions.pop(self.id, None)
+                Scheduler.remove(self.id)
+            elif sensor.onchange_session is self:
                 sensor.onchange_session = None
+            board.sessions.pop(self.id, None)
+            SESSIONS.pop(self.id, None)
+            await SessionWriter.close(self.storage)
+            Rollup.unregister(self.id)
+            Rules.unwatch(self.id)
+            Alerts.forget(self.id)
             
-            sessions = read_json(SESS_FIL)
-
             if clean:
-                sessions['active'].pop(self.id)
-                write_json(SESS_FIL, sessions)
+                SessionManager.remove_session(self.id)
+                await run_io(self.rollup.remove)
             else:
-                sessions = read_json(SESS_FIL)
-                # fix tempora, cambiar a save_session
-                if self.id in sessions['active'].keys():
-                    sessions['active'][self.id]["active"] = False
-                    sessions['active'][self.id]["finished"] = True
-                    sessions['finished'].update({self.id:sessions['active'][self.id]})
-                    sessions['active'].pop(self.id)
-                write_json(SESS_FIL, sessions)
+                self.save_session()
+                await run_io(self.rollup.save)
 
-        def save_session(self) -> None:
-            session = {
+        def as_dict(self) -> dict:
+            d = {
                 "id": self.id,
                 "board": self.board,
                 "sensor": self.sensor,
@@ -385,47 +2357,55 @@ class Board:
                 "start_date": self.start_date,
                 "finish_date": self.finish_date,
                 "file": self.file,
+                "storage": self.storage.name,
                 "active": self.active,
                 "finished": self.finished,
                 "alert": {
                     "status": self.alert,
                     "min_value": self.min_value,
-                    "max_value": self.max_value
+                    "max_value": self.max_value,
+                    "rules": [r.spec for r in self.rules if r.spec]
                 }
             }
-            sessions = read_json(SESS_FIL)
-            # cambiar
-            if self.finished:
-                if self.id in sessions['finished'].keys():
-                    sessions['finished'][self.id] = session
-                else:
-                    sessions['finished'].update({self.id: session})           
-            elif self.active:
-                if self.id in sessions['active'].keys():
-                    sessions['active'][self.id] = session
-                else:
-                    sessions['active'].update({self.id: session})
-            elif not self.active:
-                if self.id in sessions['inactive'].keys():
-                    sessions['inactive'][self.id] = session
-                else:
-                    sessions['inactive'].update({self.id: session})
-
-            
-            write_json(SESS_FIL, sessions)
+            return d
 
-        def write(self, value) -> None:
-            ts = time_stamp()
-            if self.alert:
-                self.alert_value(value)
-            write_data(self.file, f"{ts},{value}")
-        
-        def alert_value(self, value) -> None:
-            if value >= self.max_value or value <= self.min_value:
-                log(LOG_FILE, "Data alert", "", telegram=True)
+        def save_session(self) -> None:
+            SessionManager.update_session(self.as_dict())
+
+        def write(self, value, ts=None) -> None:
+            t0 = perf_counter()
+            ts = ts or int(time())
+            Rules.latest[(self.board, self.sensor)] = (ts, value)
+            if self.rules:
+                self.check(((ts, value),))
+            self.rollup.add(ts, value)
+            WAL.append(self.storage, ((ts, value),))
+            SessionWriter.append(self.storage, ts, value)
+            SESSION_WRITE.observe(perf_counter() - t0)
+
+        def store(self, rows: list) -> None:
+            """Batch of (ts, value) rows to the rollups and the writer"""
+            t0 = perf_counter()
+            add = self.rollup.add
+            for ts, value in rows:
+                add(ts, value)
+            WAL.append(self.storage, rows)
+            SessionWriter.extend(self.storage, rows)
+            SESSION_WRITE.observe(perf_counter() - t0)
+
+        def check(self, points) -> None:
+            """Feeds (ts, value) points to the alert rules, in sample order"""
+            rules = self.rules
+            for ts, value in points:
+                for rule in rules:
+                    text = rule.feed(ts, value)
+                    if text:
+                        Alerts.notify(self, rule, text)
 
     class Sensor:
 
+        __slots__ = ('id', 'model', 'type', 'measure', 'onchange_session', 'interval_sessions')
+
         _id_num = 1
         
         def __init__(self, model, stype, measure, sid=None):
@@ -433,7 +2413,7 @@ class Board:
                 self.id = f"sn0{self._id_num}" if self._id_num < 10 else f"sn{self._id_num}"
             else:
                 self.id = sid
-            self._id_num += 1
+            Board.Sensor._id_num += 1
             self.model = model
             self.type = stype
             self.measure = measure
@@ -449,34 +2429,55 @@ class Board:
             }
             return d
 
-    def __init__(self, bid, ip, timec):
+    def __init__(self, bid, ip, timec, port=80):
         self.id = bid
         self.ip = ip
         self.connection_date = timec
         self.sensors = {}
-        self.url = f"http://{ip}:80/data"
+        self.url = f"http://{ip}:{port}/data"
         self.on_change_events = False
-        self.sessions = []
+        self.sessions = {}  # id -> running or waiting session
+        self.ws_connection = None
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        """Board of an as_dict() record"""
+        port = urlsplit(d['url']).port if d.get('url') else None
+        board = cls(d['id'], d['ip'], d.get('connection'), port or 80)
+        board.on_change_events = d.get('onchange_events', False)
+        sensors = d['sensors']
+        for s in [sensors] if isinstance(sensors, dict) else sensors:
+            board.new_sensor(s['model'], s['type'], s['measure'], sid=s['id'])
+        return board
 
     def new_sensor(self, model, stype, measure, sid=None) -> None:
         sensor = self.Sensor(model, stype, measure, sid=sid)
         self.sensors.update({model: sensor})
 
+    def set_address(self, ip, port=80) -> None:
+        self.ip = ip
+        self.url = f"http://{ip}:{port}/data"
+
     # considerar session y sessionmanager fuera de la clase board
-    def new_session(self, sensor, description, stype=None, interval_type=None, interval=None,
+    async def new_session(self, sensor, description, stype=None, interval_type=None, interval=None,
             start_date=None, finish_date=None,
-            alert=False, min_value=None, max_value=None):
+            alert=False, min_value=None, max_value=None, rules=None):
         session = Board.Session(self.id, sensor, description, stype,
             interval_type, interval, start_date,
-            finish_date, alert, min_value, max_value
+            finish_date, alert, min_value, max_value, rules
         )
-        if description == 'onchange':
-            self.sensors[sensor].onchange_session = session
-        elif description == 'interval':
-            self.sensors[sensor].interval_sessions.update({session.id: session})
-        self.sessions.append(session)
+        await session.create()
+        self.add_session(session)
         return session
 
+    def add_session(self, session) -> None:
+        if session.description == 'onchange':
+            self.sensors[session.sensor].onchange_session = session
+        elif session.description == 'interval':
+            self.sensors[session.sensor].interval_sessions.update({session.id: session})
+        self.sessions[session.id] = session
+        SESSIONS[session.id] = session
+
 
     def set_ws(self, ws) -> None:
         self.ws_connection = ws
@@ -501,26 +2502,1288 @@ class Board:
     def sensors_list(self) -> list:
         return [s for s in self.sensors.values()]
 
-    def get_data(self, sensor=None) -> int:
+    async def get_data(self, sensor=None) -> int:
         res = None
         if sensor in self.sensors.keys():
-            res = requests.get(self.url, params={"sensor": sensor}).text.split(':')
-            return int(res[1])
+            t0 = perf_counter()
+            try:
+                res = (await fetch(self.url, {"sensor": sensor})).split(':')
+                value = int(res[1])
+                if not VALUE_MIN <= value <= VALUE_MAX:
+                    raise ValueError(f"sensor {sensor}: value {value} out of range")
+                return value
+            except Exception:
+                POLL_ERRORS.inc((self.id,))
+                raise
+            finally:
+                BOARD_POLL.observe(perf_counter() - t0, (self.id,))
         return None
 
     def save_board(self) -> None:
-        if os.path.isfile(DEV_FILE) and not DEBUG:
-            dev = read_json(DEV_FILE)
-            dev['devices'].append(self.as_dict())            
-            write_json(DEV_FILE, dev)
+        """Appends the board to the state change log, see State"""
+        State.record(self.as_dict())
 
-        elif not DEBUG:
-            write_json(DEV_FILE, {"devices": [self.as_dict()]})
-    
-    def on_change(self, opt) -> None:
+    async def on_change(self, opt) -> None:
         self.on_change_events = opt
         option = 'sendon' if opt else 'sendoff'
-        requests.get(f'{self.url}/config?option={option}')
+        await fetch(f'{self.url}/config', {"option": option})
+        await run_io(self.save_board)
+
+
+#########
+# State #
+#########
+
+# What startup needs without reading the history: state.json is a snapshot
+# of the boards with their sensors and of the SessionManager's archive index
+# (finished session -> archive offset, and how far each archive file was
+# read). state.log holds the boards added or changed since, one json line
+# each. At startup the snapshot is loaded, then the log and only the archive
+# lines after the snapshot, and the active and waiting sessions of
+# sessions.json are rebuilt; storage positions come from the WAL checkpoint.
+# A new snapshot replaces both on a clean stop, or at startup when anything
+# was replayed.
+
+class State:
+
+    _file = STATE_FILE
+    _log_file = STATE_LOG
+    _lock = Lock()  # the log is appended from I/O threads
+    _replayed = 0   # log records and archive bytes read past the snapshot
+
+    @classmethod
+    def record(cls, board: dict) -> None:
+        """Log a new or changed board (blocking)"""
+        line = json.dumps(board, separators=(',', ':')) + '\n'
+        with cls._lock:
+            with open(cls._log_file, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @classmethod
+    def load(cls) -> dict:
+        """Boards of the snapshot and the log into BOARDS, returns the
+        snapshot's archive index for SessionManager.load_sessions"""
+        snapshot = read_json(cls._file)
+        if snapshot.get('workers', WORKERS) != WORKERS:
+            snapshot = {}  # boards moved between workers, nothing to trust
+        boards = {d['id']: d for d in snapshot.get('boards', [])}
+        if not snapshot and os.path.isfile(DEV_FILE):
+            boards = {d['id']: d for d in read_json(DEV_FILE).get('devices', [])}
+            cls._replayed += len(boards)
+        if os.path.isfile(cls._log_file):
+            with open(cls._log_file, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # torn by a crash
+                    d = json.loads(line)
+                    boards[d['id']] = d
+                    cls._replayed += 1
+        for d in boards.values():
+            BOARDS[d['id']] = Board.from_dict(d)
+        return snapshot
+
+    @classmethod
+    def restore(cls, snapshot: dict) -> None:
+        """Sessions of the boards loaded by load(), after the WAL replay"""
+        read = snapshot.get('archives', {})
+        cls._replayed += sum(size - read.get(fp, 0) for fp, size in SessionManager._scanned.items())
+        restored = 0
+        for record in SessionManager.unfinished():
+            board = BOARDS.get(record['board'])
+            if board is None or record['sensor'] not in board.sensors:
+                log("error", f"Session {record['id']}: unknown sensor {record['sensor']}, not restored",
+                    board=record['board'])
+                continue
+            try:
+                session = Board.Session.restore(record)
+            except (KeyError, ValueError) as e:
+                log("error", f"Session {record['id']} not restored: {e}", board=record['board'])
+                continue
+            board.add_session(session)
+            if session.active:
+                if session.description == 'interval':
+                    Scheduler.add(session)
+                Rules.watch(session)
+            restored += 1
+        if restored:
+            log("session", f"{restored} sessions restored")
+        if cls._replayed or not os.path.isfile(cls._file):
+            cls.save()
+
+    @classmethod
+    def save(cls) -> None:
+        """New snapshot, the change log starts over (blocking). Runs on the
+        IOLoop thread, at startup and on stop, so BOARDS does not change."""
+        data = {
+            "workers": WORKERS,
+            "saved": time_stamp(),
+            "boards": [board.as_dict() for board in BOARDS.values()]
+        }
+        data.update(SessionManager.archive_index())
+        with cls._lock:
+            replace_json(cls._file, data)
+            with open(cls._log_file, 'w'):
+                pass
+        cls._replayed = 0
+
+
+##########
+# Alerts #
+##########
+
+class Notifier:
+    """Single sender of outgoing notifications, Telegram by default.
+
+    Messages are queued to one thread that reuses a requests.Session, so a
+    burst of alerts never opens a thread or a connection per message. At
+    most NOTIFY_QUEUE messages wait; newer ones are dropped and counted.
+    NOTIFY_URL may point at a local stub, which gets chat_id, parse_mode
+    and text as query arguments.
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tc-notify")
+    _session = None
+    _pending = 0
+    _lock = Lock()  # log() sends from any thread
+
+    @classmethod
+    def send(cls, msg: str) -> None:
+        with cls._lock:
+            if cls._pending >= NOTIFY_QUEUE:
+                NOTIFICATIONS.inc(('dropped',))
+                return
+            cls._pending += 1
+        cls._executor.submit(cls._deliver, msg)
+
+    @classmethod
+    def _deliver(cls, msg: str) -> None:
+        """Sender thread"""
+        with cls._lock:
+            cls._pending -= 1
+        if cls._session is None:
+            cls._session = requests.Session()
+        params = {"chat_id": TELEGRAM_CHATID, "parse_mode": "Markdown", "text": msg}
+        try:
+            res = cls._session.get(NOTIFY_URL.format(token=TELEGRAM_TOKEN), params=params,
+                timeout=HTTP_TIMEOUT)
+            ok = res.ok and res.json().get('ok', True)
+        except (requests.RequestException, ValueError):
+            ok = False
+        NOTIFICATIONS.inc(('sent' if ok else 'failed',))
+
+
+class Alerts:
+    """Notifications of the sessions' alert rules.
+
+    Every rule change is notified, except that changes within
+    ALERT_COOLDOWN seconds of a session's last notification are folded into
+    one digest, sent when the cooldown ends.
+    """
+
+    class State:
+
+        __slots__ = ('board', 'label', 'sent', 'pending')
+
+        def __init__(self, session):
+            self.board = session.board
+            self.label = f"{session.board}/{session.sensor} session {session.id}"
+            self.sent = 0.0
+            self.pending = []  # "rule: change" texts waiting for the digest
+
+    _states = {}  # session id -> State
+    _callback = None
+
+    @classmethod
+    def start(cls) -> None:
+        if cls._callback is None:
+            cls._callback = PeriodicCallback(cls.send_digests, 1000)
+            cls._callback.start()
+
+    @classmethod
+    def notify(cls, session, rule, text: str) -> None:
+        ALERT_CHANGES.inc((rule.level,))
+        st = cls._states.get(session.id)
+        if st is None:
+            st = cls._states[session.id] = cls.State(session)
+        now = time()
+        if now - st.sent < ALERT_COOLDOWN:
+            st.pending.append(f"{rule.name}: {text}")
+            return
+        st.sent = now
+        log("Data alert", f"{st.label} {rule.name}: {text}", telegram=True, board=st.board)
+
+    @staticmethod
+    def _digest(st, now: float) -> None:
+        changes, st.pending = st.pending, []
+        st.sent = now
+        log("Data alert", f"{st.label} {len(changes)} alert changes in "
+            f"{ALERT_COOLDOWN:g}s, last {changes[-1]}", telegram=True, board=st.board)
+
+    @classmethod
+    def send_digests(cls) -> None:
+        now = time()
+        for st in cls._states.values():
+            if st.pending and now - st.sent >= ALERT_COOLDOWN:
+                cls._digest(st, now)
+
+    @classmethod
+    def forget(cls, sid: str) -> None:
+        """Drops a finished session, sending its pending digest first"""
+        st = cls._states.pop(sid, None)
+        if st is not None and st.pending:
+            cls._digest(st, time())
+
+
+#########
+# Rules #
+#########
+
+# Alert rules of a session, given in the "rules" list of a /session body:
+#
+#   {"type": "threshold", "agg": "mean", "window": "60s", "op": ">", "value": 30}
+#   {"type": "rate", "window": "5m", "op": ">", "value": 0.1}    change per second
+#   {"type": "stale", "after": "2m"}                             no samples
+#   {"type": "delta", "sensor": "lm35", "op": ">", "value": 3, "abs": true}
+#
+# A window is a number of samples (10) or a duration ("30s", "5m", "1h").
+# Every rule takes an optional "name". Rules are compiled once into
+# evaluators that keep running state, so each sample costs O(1) per rule.
+
+OPS = {">": gt, ">=": ge, "<": lt, "<=": le}
+DURATION = {"s": 1, "m": 60, "h": 3600}
+
+
+def parse_window(window) -> tuple:
+    """(samples, seconds) of a window spec, one of them None"""
+    if is_number(window) and window == int(window) and window > 0:
+        return int(window), None
+    if isinstance(window, str) and window[-1:] in DURATION:
+        seconds = float(window[:-1]) * DURATION[window[-1]]
+        if seconds > 0:
+            return None, seconds
+    raise ValueError(f"bad window {window!r}")
+
+
+class Window:
+    """Rolling mean, max or min over the last samples or seconds.
+
+    Samples are kept with a running sum, and for max and min a monotonic
+    deque whose head is the current extreme, so adding a sample is
+    amortized O(1) whatever the window size."""
+
+    AGGS = ('mean', 'max', 'min', 'last')
+
+    def __init__(self, window, agg='mean'):
+        if agg not in self.AGGS:
+            raise ValueError(f"bad agg {agg!r}")
+        self.samples, self.seconds = parse_window(window)
+        self.agg = agg
+        self.items = deque()    # (seq, ts, value)
+        self.extreme = deque()  # (seq, value), max or min first
+        self.total = 0.0
+        self.seq = 0
+
+    def add(self, ts: float, value) -> float:
+        self.seq += 1
+        items, extreme = self.items, self.extreme
+        items.append((self.seq, ts, value))
+        self.total += value
+        if self.agg == 'max':
+            while extreme and extreme[-1][1] <= value:
+                extreme.pop()
+            extreme.append((self.seq, value))
+        elif self.agg == 'min':
+            while extreme and extreme[-1][1] >= value:
+                extreme.pop()
+            extreme.append((self.seq, value))
+
+        if self.seconds:
+            while items[0][1] <= ts - self.seconds:
+                self._evict()
+        else:
+            while len(items) > self.samples:
+                self._evict()
+        return self.value()
+
+    def _evict(self) -> None:
+        seq, _, value = self.items.popleft()
+        self.total -= value
+        if self.extreme and self.extreme[0][0] == seq:
+            self.extreme.popleft()
+
+    def value(self) -> float:
+        if self.agg == 'mean':
+            return self.total / len(self.items)
+        if self.agg == 'last':
+            return self.items[-1][2]
+        return self.extreme[0][1]
+
+    def first(self) -> tuple:
+        """(ts, value) of the oldest sample in the window"""
+        return self.items[0][1:]
+
+
+class Rule:
+    """Compiled rule, level is 'ok' or 'firing'"""
+
+    def __init__(self, spec: dict, default_name: str):
+        self.spec = spec
+        self.name = str(spec.get('name') or default_name)
+        self.level = 'ok'
+
+    def feed(self, ts: float, value):
+        """Text of the level change this sample makes, or None"""
+        firing, observed = self.evaluate(ts, value)
+        if firing:
+            return self.set('firing', f"{observed} {self.spec['op']} {self.limit:g}")
+        return self.set('ok', observed)
+
+    def set(self, level: str, text: str):
+        if level == self.level:
+            return None
+        self.level = level
+        return text if level != 'ok' else f"back to ok, {text}"
+
+    @staticmethod
+    def compare(spec: dict):
+        """(operator, limit) of the rule's op and value"""
+        op = OPS.get(spec.get('op'))
+        if op is None:
+            raise ValueError(f"bad op {spec.get('op')!r}")
+        return op, float(spec['value'])
+
+
+class RangeRule(Rule):
+    """The session's min_value and max_value, with hysteresis: a value
+    hovering at a limit doesn't flap, it has to come back inside the range
+    by ALERT_HYSTERESIS of its width."""
+
+    def __init__(self, min_value, max_value):
+        super().__init__({}, 'range')
+        self.lo, self.hi = min_value, max_value
+        self.margin = (max_value - min_value) * ALERT_HYSTERESIS
+
+    def feed(self, ts: float, value):
+        if value >= self.hi:
+            level = 'high'
+        elif value <= self.lo:
+            level = 'low'
+        elif self.level == 'high' and value > self.hi - self.margin:
+            level = 'high'
+        elif self.level == 'low' and value < self.lo + self.margin:
+            level = 'low'
+        else:
+            level = 'ok'
+        if level == self.level:
+            return None
+        self.level = level
+        if level == 'high':
+            return f"{value} above max {self.hi}"
+        if level == 'low':
+            return f"{value} below min {self.lo}"
+        return f"back in range at {value}"
+
+
+class ThresholdRule(Rule):
+
+    def __init__(self, spec: dict, default_name: str):
+        super().__init__(spec, default_name)
+        self.op, self.limit = self.compare(spec)
+        self.window = Window(spec.get('window', 1), spec.get('agg', 'mean'))
+
+    def evaluate(self, ts: float, value):
+        x = self.window.add(ts, value)
+        return self.op(x, self.limit), f"{self.window.agg} {x:g}"
+
+
+class RateRule(Rule):
+    """Change per second between the oldest sample of the window and now"""
+
+    def __init__(self, spec: dict, default_name: str):
+        super().__init__(spec, default_name)
+        self.op, self.limit = self.compare(spec)
+        self.window = Window(spec.get('window', 2), 'last')
+
+    def evaluate(self, ts: float, value):
+        self.window.add(ts, value)
+        t, v = self.window.first()
+        if ts <= t:
+            return self.level != 'ok', "rate unknown"
+        rate = (value - v) / (ts - t)
+        return self.op(rate, self.limit), f"rate {rate:.3g}/s"
+
+
+class StaleRule(Rule):
+    """Fires when no sample arrived for `after`, checked by Rules.tick"""
+
+    def __init__(self, spec: dict, default_name: str):
+        super().__init__(spec, default_name)
+        samples, self.after = parse_window(spec.get('after'))
+        if self.after is None:
+            raise ValueError("stale needs a duration")
+        self.last = time()
+
+    def feed(self, ts: float, value):
+        self.last = time()
+        return self.set('ok', f"sample after {self.spec['after']}")
+
+    def tick(self, now: float):
+        if now - self.last < self.after:
+            return None
+        return self.set('firing', f"no samples for {now - self.last:.0f}s")
+
+
+class DeltaRule(Rule):
+    """This sensor's window aggregate minus the last value of another sensor
+    of the same board, like the dht11 vs lm35 test"""
+
+    def __init__(self, spec: dict, default_name: str, board: str):
+        super().__init__(spec, default_name)
+        self.op, self.limit = self.compare(spec)
+        self.other = (board, str(spec['sensor']))
+        self.abs = bool(spec.get('abs', False))
+        self.window = Window(spec.get('window', 1), spec.get('agg', 'last'))
+
+    def evaluate(self, ts: float, value):
+        x = self.window.add(ts, value)
+        other = Rules.latest.get(self.other)
+        if other is None:
+            return self.level != 'ok', f"no {self.other[1]} value"
+        delta = x - other[1]
+        if self.abs:
+            delta = abs(delta)
+        return self.op(delta, self.limit), f"delta to {self.other[1]} {delta:g}"
+
+
+class Rules:
+    """Compiles rule specs, keeps the last value of every sensor for the
+    delta rules and checks the stale rules of the running sessions"""
+
+    TYPES = {
+        "threshold": ThresholdRule,
+        "rate": RateRule,
+        "stale": StaleRule,
+        "delta": DeltaRule
+    }
+
+    latest = {}     # (board, sensor) -> (ts, value)
+    _watched = {}   # session id -> session with stale rules
+    _callback = None
+
+    @classmethod
+    def compile(cls, specs, board: str) -> list:
+        """Rule evaluators of a "rules" list, ValueError if any is bad"""
+        if not isinstance(specs, list):
+            raise ValueError("rules must be a list")
+        rules = []
+        for i, spec in enumerate(specs):
+            try:
+                kind = cls.TYPES[spec['type']]
+                name = f"{spec['type']}{i}"
+                rule = kind(spec, name, board) if kind is DeltaRule else kind(spec, name)
+            except (KeyError, TypeError, AttributeError) as e:
+                raise ValueError(f"bad rule {spec!r}") from e
+            rules.append(rule)
+        return rules
+
+    @classmethod
+    def start(cls) -> None:
+        if cls._callback is None:
+            cls._callback = PeriodicCallback(cls.tick, 1000)
+            cls._callback.start()
+
+    @classmethod
+    def watch(cls, session) -> None:
+        stale = [r for r in session.rules if isinstance(r, StaleRule)]
+        if stale:
+            now = time()
+            for r in stale:
+                r.last = now
+            cls._watched[session.id] = session
+
+    @classmethod
+    def unwatch(cls, sid: str) -> None:
+        cls._watched.pop(sid, None)
+
+    @classmethod
+    def tick(cls) -> None:
+        now = time()
+        for session in cls._watched.values():
+            for rule in session.rules:
+                if isinstance(rule, StaleRule):
+                    text = rule.tick(now)
+                    if text:
+                        Alerts.notify(session, rule, text)
+
+
+#######
+# Hub #
+#######
+
+def lttb(points: list, n: int) -> list:
+    """Largest-Triangle-Three-Buckets downsampling of [(t, v), ...] to n
+    points, keeps the visual shape of a series for charts"""
+    size = len(points)
+    if n >= size or n < 3:
+        return points
+    out = [points[0]]
+    every = (size - 2) / (n - 2)
+    a = 0
+    for i in range(n - 2):
+        # average of the next bucket
+        start = int((i + 1) * every) + 1
+        end = min(int((i + 2) * every) + 1, size)
+        nxt = points[start:end]
+        avg_t = sum(p[0] for p in nxt) / len(nxt)
+        avg_v = sum(p[1] for p in nxt) / len(nxt)
+        # point of this bucket making the largest triangle with a and avg
+        ta, va = points[a]
+        best = -1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            t, v = points[j]
+            area = abs((ta - avg_t) * (v - va) - (ta - t) * (avg_v - va))
+            if area > best:
+                best = area
+                a_next = j
+        out.append(points[a_next])
+        a = a_next
+    out.append(points[-1])
+    return out
+
+
+class Channel:
+    """Subscribers of one topic sharing one push policy.
+
+    Without a policy every value is pushed as it comes. With one, values
+    are collected per (board, sensor) and pushed at most `rate` times per
+    second as a single frame, reduced by `agg`:
+    all (every sample), last, minmax (the min and max samples) or lttb
+    (`points` samples chosen by LTTB).
+    """
+
+    AGGS = ('all', 'last', 'minmax', 'lttb')
+
+    def __init__(self, topic: str, policy=None):
+        self.topic = topic
+        self.policy = policy
+        self.subscribers = set()
+        self._series = {}
+        self._callback = None
+        if policy:
+            rate, self.agg, self.points = policy
+            self._callback = PeriodicCallback(self.flush, 1000 / rate)
+            self._callback.start()
+
+    @classmethod
+    def parse_policy(cls, policy):
+        """(rate, agg, points) from a subscribe message, None for raw"""
+        if not policy:
+            return None
+        rate = min(float(policy.get('rate', 1)), MAX_PUSH_RATE)
+        agg = policy.get('agg', 'all')
+        points = int(policy.get('points', 100))
+        if rate <= 0 or agg not in cls.AGGS or points < 1:
+            raise ValueError(policy)
+        return rate, agg, points
+
+    def add(self, key: tuple, ts: float, value) -> None:
+        s = self._series.get(key)
+        if self.agg == 'last':
+            self._series[key] = (ts, value)
+        elif self.agg == 'minmax':
+            if s is None:
+                self._series[key] = [ts, value, ts, value]
+            elif value < s[1]:
+                s[0], s[1] = ts, value
+            elif value > s[3]:
+                s[2], s[3] = ts, value
+        else:
+            if s is None:
+                s = self._series[key] = deque(maxlen=PUSH_WINDOW)
+            s.append((ts, value))
+
+    def _points(self, s) -> list:
+        if self.agg == 'last':
+            return [s]
+        if self.agg == 'minmax':
+            lo, hi = (s[0], s[1]), (s[2], s[3])
+            return [lo] if lo == hi else sorted([lo, hi])
+        s = list(s)
+        return lttb(s, self.points) if self.agg == 'lttb' else s
+
+    def flush(self) -> None:
+        if not self._series:
+            return
+        series, self._series = self._series, {}
+        frame = json.dumps({
+            "type": "values",
+            "agg": self.agg,
+            "series": [{
+                "board": board,
+                "sensor": sensor,
+                "points": [[round(t, 3), v] for t, v in self._points(s)]
+            } for (board, sensor), s in series.items()]
+        })
+        Hub.count_frame(len(self.subscribers))
+        for client in self.subscribers:
+            client.send(frame)
+
+    def close(self) -> None:
+        if self._callback:
+            self._callback.stop()
+
+
+class Hub:
+    """Fan-out of live values to client websockets.
+
+    Clients subscribe to topics: "board/sensor", "board/*" or "*", each
+    with an optional push policy (see Channel). Subscribers of the same
+    topic and policy share a channel, so every frame is encoded once and
+    the same string is queued to all of them. A client's queue holds
+    CLIENT_QUEUE frames and drops the oldest when the client can't keep
+    up, so a slow dashboard never blocks ingest.
+    """
+
+    _topics = {}     # topic -> {policy: Channel}
+    _clients = set()
+
+    _frames = 0
+    _sent = 0
+
+    @classmethod
+    def join(cls, client) -> None:
+        cls._clients.add(client)
+
+    @classmethod
+    def leave(cls, client) -> None:
+        cls.unsubscribe(client)
+        cls._clients.discard(client)
+
+    @classmethod
+    def subscribe(cls, client, topics: list, policy=None) -> None:
+        for topic in topics:
+            channels = cls._topics.setdefault(topic, {})
+            channel = channels.get(policy)
+            if channel is None:
+                channel = channels[policy] = Channel(topic, policy)
+            channel.subscribers.add(client)
+            client.channels.add(channel)
+
+    @classmethod
+    def unsubscribe(cls, client, topics=None) -> None:
+        for channel in list(client.channels):
+            if topics is not None and channel.topic not in topics:
+                continue
+            client.channels.discard(channel)
+            channel.subscribers.discard(client)
+            if not channel.subscribers:
+                channel.close()
+                channels = cls._topics[channel.topic]
+                del channels[channel.policy]
+                if not channels:
+                    del cls._topics[channel.topic]
+
+    @classmethod
+    def channels(cls, board: str, sensor: str) -> list:
+        topics = cls._topics
+        found = []
+        for topic in (f"{board}/{sensor}", f"{board}/*", "*"):
+            channels = topics.get(topic)
+            if channels:
+                found.extend(channels.values())
+        return found
+
+    @classmethod
+    def publish(cls, board: str, sensor: str, value, ts=None) -> None:
+        if Relay.enabled:
+            Relay.forward(board, sensor, ((ts or time(), value),))
+            return
+        if not cls._topics:
+            return
+        channels = cls.channels(board, sensor)
+        if not channels:
+            return
+        raw = set()
+        for channel in channels:
+            if channel.policy is None:
+                raw |= channel.subscribers
+            else:
+                channel.add((board, sensor), ts or time(), value)
+        if not raw:
+            return
+        frame = json.dumps({
+            "type": "value",
+            "board": board,
+            "sensor": sensor,
+            "value": value
+        })
+        cls.count_frame(len(raw))
+        for client in raw:
+            client.send(frame)
+
+    @classmethod
+    def publish_many(cls, board: str, sensor: str, points: list) -> None:
+        """Batch of (ts, value) points of one sensor. Subscribers without a
+        policy get them in a single "values" frame."""
+        if Relay.enabled:
+            Relay.forward(board, sensor, points)
+            return
+        if not cls._topics:
+            return
+        channels = cls.channels(board, sensor)
+        if not channels:
+            return
+        raw = set()
+        key = (board, sensor)
+        for channel in channels:
+            if channel.policy is None:
+                raw |= channel.subscribers
+            else:
+                for ts, value in points:
+                    channel.add(key, ts, value)
+        if not raw:
+            return
+        frame = json.dumps({
+            "type": "values",
+            "agg": "all",
+            "series": [{
+                "board": board,
+                "sensor": sensor,
+                "points": [[round(t, 3), v] for t, v in points]
+            }]
+        })
+        cls.count_frame(len(raw))
+        for client in raw:
+            client.send(frame)
+
+    @classmethod
+    def count_frame(cls, subscribers: int) -> None:
+        cls._frames += 1
+        cls._sent += subscribers
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "clients": len(cls._clients),
+            "topics": len(cls._topics),
+            "channels": sum(len(c) for c in cls._topics.values()),
+            "frames": cls._frames,
+            "sent": cls._sent,
+            "dropped": sum(c.dropped for c in cls._clients)
+        }
+
+
+##########
+# Ingest #
+##########
+
+class Ingest:
+    """Staged pipeline between the board websockets and the sessions.
+
+    Receive handlers only parse frames and put them in a bounded queue as
+    (board id, [(sensor, [(ts, value), ...]), ...]). A consumer takes up to
+    INGEST_BATCH frames per round, merges them per sensor and runs the
+    stages: storage (rollups and SessionWriter buffers), alerts and
+    broadcast to the Hub. With INGEST_QUEUE frames queued INGEST_POLICY
+    applies:
+
+    pause  the board socket stops reading until there is room
+    drop   new frames are dropped and counted
+    spill  new frames go to files in SPILL_DIR and are read back, in
+           order, once the queue drains
+    """
+
+    STAGES = ('queue', 'storage', 'alerts', 'broadcast')
+
+    _queue = deque()
+    _ready = None   # tornado locks are created in start(), after forking
+    _space = None
+    _done = None
+    _running = False
+    _stopping = False
+
+    _spill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tc-spill")
+    _spill_buf = []         # newest spilled frames, not written yet
+    _spill_files = deque()  # (path, frames), oldest first
+    _spill_seq = count()
+    _spilled = 0
+
+    _received = 0
+    _dropped = 0
+    _latency = {stage: [0, 0.0, 0.0] for stage in STAGES}  # count, total ms, max ms
+
+    @classmethod
+    def start(cls) -> None:
+        """Starts the consumer, picking up spill files of a previous run"""
+        if cls._running:
+            return
+        cls._ready, cls._space, cls._done = Event(), Condition(), Event()
+        os.makedirs(SPILL_DIR, exist_ok=True)
+        names = sorted(f for f in os.listdir(SPILL_DIR) if f.endswith('.spill'))
+        for name in names:
+            fp = f"{SPILL_DIR}/{name}"
+            with open(fp, 'rb') as f:
+                frames = sum(1 for _ in f)
+            cls._spill_files.append((fp, frames))
+            cls._spilled += frames
+        if names:
+            cls._spill_seq = count(int(names[-1].split('.')[0]) + 1)
+        cls._running = True
+        IOLoop.current().spawn_callback(cls._consume)
+
+    @classmethod
+    def put(cls, board_id: str, series: list):
+        """Queues a received frame. Returns None, or with the pause policy
+        and a full queue an awaitable; returned from on_message it keeps
+        Tornado from reading the socket until the frame is queued."""
+        cls._received += 1
+        frame = (board_id, series, time())
+        if cls._spilled:
+            cls._spill(frame)
+        elif len(cls._queue) < INGEST_QUEUE:
+            cls._queue.append(frame)
+            cls._ready.set()
+        elif INGEST_POLICY == 'spill':
+            cls._spill(frame)
+        elif INGEST_POLICY == 'drop':
+            cls._dropped += 1
+        else:
+            return cls._wait(frame)
+        return None
+
+    @classmethod
+    async def _wait(cls, frame: tuple) -> None:
+        while len(cls._queue) >= INGEST_QUEUE:
+            await cls._space.wait()
+        cls._queue.append(frame)
+        cls._ready.set()
+
+    @classmethod
+    def _spill(cls, frame: tuple) -> None:
+        cls._spilled += 1
+        cls._spill_buf.append(frame)
+        if len(cls._spill_buf) >= INGEST_BATCH:
+            cls._spill_out()
+
+    @classmethod
+    def _spill_out(cls) -> None:
+        fp = f"{SPILL_DIR}/{next(cls._spill_seq):08d}.spill"
+        frames, cls._spill_buf = cls._spill_buf, []
+        cls._spill_files.append((fp, len(frames)))
+        cls._spill_executor.submit(cls._write_spill, fp, frames)
+
+    @staticmethod
+    def _write_spill(fp: str, frames: list) -> None:
+        """Spill thread"""
+        try:
+            with open(fp, 'w') as f:
+                f.writelines(json.dumps(frame) + '\n' for frame in frames)
+        except OSError as e:
+            log("error", f"Ingest spill {fp} failed: {e}")
+
+    @staticmethod
+    def _read_spill(fp: str) -> list:
+        """Spill thread"""
+        try:
+            with open(fp, 'r') as f:
+                frames = [json.loads(line) for line in f]
+            os.remove(fp)
+        except (OSError, ValueError) as e:
+            log("error", f"Ingest spill {fp} lost: {e}")
+            frames = []
+        return frames
+
+    @classmethod
+    async def _unspill(cls) -> None:
+        """Processes the oldest spilled frames"""
+        if cls._spill_files:
+            fp, n = cls._spill_files.popleft()
+            cls._spilled -= n
+            frames = await IOLoop.current().run_in_executor(
+                cls._spill_executor, cls._read_spill, fp)
+            cls._dropped += n - len(frames)  # lost with a corrupt file
+        else:
+            frames, cls._spill_buf = cls._spill_buf, []
+            cls._spilled -= len(frames)
+        cls._round(frames)
+
+    @classmethod
+    def _round(cls, batch: list) -> None:
+        """_process, a failing round drops its frames instead of ending the
+        consumer"""
+        try:
+            cls._process(batch)
+        except Exception as e:
+            cls._dropped += len(batch)
+            log("error", f"Ingest: {len(batch)} frames dropped: {e!r}")
+
+    @classmethod
+    async def _consume(cls) -> None:
+        queue = cls._queue
+        try:
+            while True:
+                if queue:
+                    batch = [queue.popleft() for _ in range(min(len(queue), INGEST_BATCH))]
+                    cls._space.notify_all()
+                    cls._round(batch)
+                    # let the sockets read between rounds
+                    await gen.sleep(0)
+                elif cls._spilled:
+                    try:
+                        await cls._unspill()
+                    except Exception as e:
+                        log("error", f"Ingest: reading back spilled frames failed: {e!r}")
+                elif cls._stopping:
+                    break
+                else:
+                    cls._ready.clear()
+                    await cls._ready.wait()
+        finally:
+            cls._done.set()
+
+    @classmethod
+    def _observe(cls, stage: str, ms: float, n=1) -> None:
+        lat = cls._latency[stage]
+        lat[0] += n
+        lat[1] += ms * n
+        if ms > lat[2]:
+            lat[2] = ms
+
+    @classmethod
+    def _process(cls, batch: list) -> None:
+        if not batch:
+            return
+        now = time()
+        merged = {}
+        for board_id, series, received in batch:
+            cls._observe('queue', (now - received) * 1000)
+            for sen, points in series:
+                key = (board_id, sen)
+                current = merged.get(key)
+                if current is None:
+                    merged[key] = list(points)
+                else:
+                    current.extend(points)
+
+        t0 = perf_counter()
+        targets = []
+        for (board_id, sen), points in merged.items():
+            board = BOARDS.get(board_id)
+            sensor = board.sensors.get(sen) if board else None
+            if sensor is None:
+                continue
+            session = sensor.onchange_session
+            if session:
+                session.store([(int(ts), v) for ts, v in points])
+            targets.append((board_id, sen, session, points))
+
+        t1 = perf_counter()
+        latest = Rules.latest
+        for board_id, sen, session, points in targets:
+            latest[(board_id, sen)] = points[-1]
+            if session and session.rules:
+                session.check(points)
+
+        t2 = perf_counter()
+        for board_id, sen, _, points in targets:
+            if len(points) == 1:
+                ts, value = points[0]
+                Hub.publish(board_id, sen, value, ts)
+            else:
+                Hub.publish_many(board_id, sen, points)
+
+        t3 = perf_counter()
+        n = len(batch)
+        cls._observe('storage', (t1 - t0) * 1000 / n, n)
+        cls._observe('alerts', (t2 - t1) * 1000 / n, n)
+        cls._observe('broadcast', (t3 - t2) * 1000 / n, n)
+
+    @classmethod
+    async def stop(cls) -> None:
+        """Drains the queue and the spilled frames into the sessions"""
+        if not cls._running:
+            return
+        cls._stopping = True
+        cls._ready.set()
+        await cls._done.wait()
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "policy": INGEST_POLICY,
+            "queued": len(cls._queue),
+            "spilled": cls._spilled,
+            "received": cls._received,
+            "dropped": cls._dropped,
+            "latency_ms": {stage: {
+                "count": n,
+                "avg": round(total / n, 3) if n else 0.0,
+                "max": round(mx, 3)
+            } for stage, (n, total, mx) in cls._latency.items()}
+        }
+
+
+###########
+# Workers #
+###########
+
+# --workers N: the first process becomes a Dispatcher in front of N forked
+# workers. Boards are sharded by a consistent hash of their id; worker 0
+# also serves everything not tied to a board (clients, / and the stop).
+
+RING_POINTS = 64  # points per worker on the hash ring
+
+_ring = []
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+def owner(board_id: str) -> int:
+    """Worker owning a board, stable across restarts and processes"""
+    if WORKERS == 1:
+        return 0
+    if not _ring:
+        _ring.extend(sorted((_hash(f"worker-{w}-{p}"), w)
+            for w in range(WORKERS) for p in range(RING_POINTS)))
+    i = bisect_left(_ring, (_hash(board_id), -1))
+    return _ring[i % len(_ring)][1]
+
+
+def session_worker(sid: str) -> int:
+    """Worker that created a session, from the -wN of its id (0 without)"""
+    _, sep, rest = sid.partition('-w')
+    num = rest.split('-', 1)[0]
+    return int(num) if sep and num.isdecimal() else 0
+
+
+def worker_url(worker: int, scheme='http') -> str:
+    return f"{scheme}://127.0.0.1:{INTERNAL_PORT + worker}"
+
+
+async def _fetch_json(url: str):
+    try:
+        res = await AsyncHTTPClient().fetch(url, request_timeout=HTTP_TIMEOUT)
+        return json.loads(res.body)
+    except Exception:
+        return None
+
+
+async def fan_out(path: str, params: dict = None) -> list:
+    """In worker 0, GETs path from every other worker and returns the
+    parsed answers. Elsewhere, or with a single process, returns []."""
+    if WORKER or WORKERS == 1:
+        return []
+    res = await gen.multi([_fetch_json(url_concat(worker_url(w) + path, params or {}))
+        for w in range(1, WORKERS)])
+    return [r for r in res if r is not None]
+
+
+class Relay:
+    """Forwards the live values of a secondary worker to worker 0, which
+    owns every client websocket. Values are batched every RELAY_MS, kept
+    while connecting and dropped if worker 0 can't be reached, as nobody
+    could see them."""
+
+    enabled = False
+    _ws = None
+    _connecting = False
+    _buffer = {}  # (board, sensor) -> [(ts, value), ...]
+
+    @classmethod
+    def start(cls) -> None:
+        cls.enabled = True
+        PeriodicCallback(cls.flush, RELAY_MS).start()
+
+    @classmethod
+    def forward(cls, board: str, sensor: str, points: list) -> None:
+        key = (board, sensor)
+        buf = cls._buffer.get(key)
+        if buf is None:
+            cls._buffer[key] = list(points)
+        else:
+            buf.extend(points)
+
+    @classmethod
+    async def _connect(cls) -> None:
+        try:
+            cls._ws = await websocket_connect(worker_url(0, 'ws') + '/ws/relay')
+        except Exception:
+            cls._ws = None
+            cls._buffer = {}
+        finally:
+            cls._connecting = False
+
+    @classmethod
+    def flush(cls) -> None:
+        if not cls._buffer:
+            return
+        if cls._ws is None:
+            if not cls._connecting:
+                cls._connecting = True
+                IOLoop.current().spawn_callback(cls._connect)
+            return
+        buffer, cls._buffer = cls._buffer, {}
+        frame = json.dumps([[board, sensor, points] for (board, sensor), points in buffer.items()])
+        try:
+            cls._ws.write_message(frame)
+        except WebSocketClosedError:
+            cls._ws = None
+
+
+class Dispatcher:
+    """Front process of --workers mode.
+
+    Accepts every connection on PORT and peeks at its request line without
+    reading it. The socket itself is then handed to a worker over a unix
+    socket (SCM_RIGHTS) and served there as if the worker had accepted it,
+    so the dispatcher never touches the frames. Requests naming a board
+    (id= on /ws/board, board= elsewhere) go to the board's owner, the
+    rest to worker 0.
+    """
+
+    PEEK_BYTES = 2048
+
+    def __init__(self, sockets: list, channels: list, pids: dict):
+        self.sockets = sockets
+        self.channels = channels
+        self.pids = pids  # pid -> worker
+        self.pending = {}  # connection not handed off yet -> its HTTP_TIMEOUT timeout
+
+    def start(self) -> None:
+        for sock in self.sockets:
+            add_accept_handler(sock, self._accept)
+        PeriodicCallback(self._reap, 1000).start()
+
+    def _accept(self, conn, address) -> None:
+        conn.setblocking(False)
+        # a client sending nothing, or stopping within its request line, is dropped
+        self.pending[conn] = IOLoop.current().call_later(HTTP_TIMEOUT, self._expire, conn)
+        self._watch(conn, address)
+
+    def _watch(self, conn, address) -> None:
+        if conn in self.pending:
+            IOLoop.current().add_handler(conn, partial(self._peek, conn, address), IOLoop.READ)
+
+    def _expire(self, conn) -> None:
+        self.pending.pop(conn, None)
+        IOLoop.current().remove_handler(conn)
+        conn.close()
+
+    def _peek(self, conn, address, fd, events) -> None:
+        io_loop = IOLoop.current()
+        try:
+            head = conn.recv(self.PEEK_BYTES, MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            head = b''
+        io_loop.remove_handler(conn)
+        line, sep, _ = head.partition(b'\r\n')
+        if head and not sep and len(head) < self.PEEK_BYTES:
+            # request line not complete yet, look again shortly
+            io_loop.call_later(0.01, self._watch, conn, address)
+            return
+        io_loop.remove_timeout(self.pending.pop(conn))
+        if not head:
+            conn.close()
+            return
+        worker, websocket = self.route(line)
+        self.handoff(worker, conn, address, websocket)
+
+    @staticmethod
+    def route(line: bytes) -> tuple:
+        """(worker, is a websocket) of a request line"""
+        parts = line.split(b' ')
+        if len(parts) < 2:
+            return 0, False
+        url = urlsplit(parts[1].decode('latin-1'))
+        websocket = url.path.startswith('/ws/')
+        if url.path == '/ws/client':
+            return 0, websocket
+        args = parse_qs(url.query)
+        board = args.get('id' if url.path == '/ws/board' else 'board')
+        return (owner(board[0]) if board else 0), websocket
+
+    def handoff(self, worker: int, conn, address, websocket: bool) -> None:
+        try:
+            self.channels[worker].sendmsg([json.dumps([address, websocket]).encode()],
+                [(SOL_SOCKET, SCM_RIGHTS, struct.pack('i', conn.fileno()))])
+        except OSError as e:
+            log("error", f"Worker {worker} unreachable: {e}")
+        conn.close()
+
+    def _reap(self) -> None:
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.pids.clear()
+                break
+            if not pid:
+                break
+            worker = self.pids.pop(pid)
+            if status:
+                log("error", f"Worker {worker} exited with status {status}", telegram=True)
+        if not self.pids:
+            IOLoop.current().stop()
+
+
+def fork_workers(n: int) -> tuple:
+    """Forks n workers and turns this process into their Dispatcher.
+    Returns (worker, handoff channel) in the workers, the dispatcher
+    exits when every worker has."""
+    sockets = bind_sockets(PORT)
+    channels = [socketpair(AF_UNIX, SOCK_DGRAM) for _ in range(n)]
+    pids = {}
+    for worker in range(n):
+        pid = os.fork()
+        if pid == 0:
+            for sock in sockets:
+                sock.close()
+            for i, (front, back) in enumerate(channels):
+                front.close()
+                if i != worker:
+                    back.close()
+            return worker, channels[worker][1]
+        pids[pid] = worker
+
+    for _, back in channels:
+        back.close()
+    Logs.start()
+    Dispatcher(sockets, [front for front, _ in channels], pids).start()
+    IOLoop.current().start()
+    Logs.stop()
+    sys.exit(0)
+
+
+def accept_handoff(app: Application, channel) -> None:
+    """Serves the connections the Dispatcher hands over on channel.
+    Plain requests are served one per connection, as the next one on a
+    kept-alive connection could be for another worker's board."""
+    fd_size = struct.calcsize('i')
+    websockets = HTTPServer(app)
+    plain = HTTPServer(app, no_keep_alive=True)
+
+    def receive(fd, events):
+        while True:
+            try:
+                msg, ancdata, _, _ = channel.recvmsg(256, CMSG_SPACE(fd_size))
+            except BlockingIOError:
+                return
+            for level, kind, data in ancdata:
+                if level == SOL_SOCKET and kind == SCM_RIGHTS:
+                    conn = socket(fileno=struct.unpack('i', data[:fd_size])[0])
+                    conn.setblocking(False)
+                    address, websocket = json.loads(msg)
+                    server = websockets if websocket else plain
+                    server.handle_stream(IOStream(conn), tuple(address))
+
+    channel.setblocking(False)
+    IOLoop.current().add_handler(channel, receive, IOLoop.READ)
 
 
 ####################
@@ -531,23 +3794,34 @@ class Board:
 
 class MainHandler(RequestHandler):
 
-    def get(self):
+    async def get(self):
         
         devices = []
         for dev in BOARDS.values():
             devices.append(dev.as_dict())
         
         response = {
-            "cronjobs": CronTab.jobs_exist(),
+            "cronjobs": await run_io(CronTab.jobs_exist),
             "host": HOSTNAME,
             "version": get_version(),
             "debug": DEBUG,
-            "logs": {
-                "len": 0,
-                "last_log": {}
-            },
+            "writer": SessionWriter.stats(),
+            "wal": WAL.stats(),
+            "scheduler": Scheduler.stats(),
+            "hub": Hub.stats(),
+            "ingest": Ingest.stats(),
+            "sessions": Rollup.live_totals(),
+            "logs": Logs.stats(),
             "devices": devices
         }
+        # --workers: every shard's boards and sessions, stats per worker
+        workers = await fan_out('/')
+        if workers:
+            response['workers'] = [{k: r[k] for k in ("writer", "wal", "scheduler", "hub", "ingest")}
+                for r in workers]
+        for r in workers:
+            response['sessions'].update(r['sessions'])
+            devices.extend(r['devices'])
         self.write(json.dumps(response))
 
 
@@ -558,67 +3832,66 @@ class Sessions(RequestHandler):
         self.sensor_m = self.get_argument('sensor', None)
         self.session_id = self.get_argument('session', None)
     
-    def get(self):
-        sessions = read_json(SESS_FIL)
-        # session_list = []
-        # if self.board_id and not self.sensor_m:
-        #     for session in sessions['sessions'].values():
-        #         if session['board'] == self.board_id:
-        #             session_list.append(session)
-
-        # elif self.board_id and self.sensor_m:
-        #     for session in sessions['sessions'].values():
-        #         if session['board'] == self.board_id and session['sensor'] == self.sensor_m:
-        #             session_list.append(session)
-
-        # elif self.session_id:
-        #     session_list.append(sessions[self.session_id])
-
-        # else:
-        #     session_list = sessions
-
+    async def get(self):
+        sessions = await SessionManager.list_sessions(self.board_id, self.sensor_m, self.session_id)
+        if not self.board_id:
+            for r in await fan_out('/session', {"session": self.session_id} if self.session_id else None):
+                for state, found in r['sessions'].items():
+                    sessions[state].update(found)
         self.write(json.dumps({"sessions": sessions}))
 
-    def post(self):
+    async def post(self):
         """{
           "board":  str,
           "sensor": str,
           "session": {
               "type": "", open or scheduled
               "description": "interval" or "onchange",
-              "interval_type": "", minute, hour, "day"
+              "interval_type": "", second, minute, hour, "day"
               "interval": int,
               "start_date": "", if start date is empty or null, the session start immediately
               "finish_date": "YYYY-MM-DD", only if defined session is True
               "alert": bool
               "min_value": None,
-              "max_value": None
+              "max_value": None,
+              "rules": [], optional, see Rules
           }
         }"""
-        print(self.request.body.decode())
         body = json.loads(self.request.body)
+        log("session", f"New session request {self.request.body.decode()}",
+            board=body.get('board'), level=logging.DEBUG)
+        worker = owner(body['board'])
+        if worker != WORKER:
+            res = await AsyncHTTPClient().fetch(worker_url(worker) + '/session', method='POST',
+                body=self.request.body, request_timeout=HTTP_TIMEOUT, raise_error=False)
+            self.set_status(res.code)
+            return
         session = body['session']
         board = BOARDS[body['board']] if body['board'] in BOARDS.keys() else None
         sensor = board.sensors[body['sensor']]
+        try:
+            rules = Rules.compile(session.get('rules', []), board.id)
+            if session['description'] == 'interval':
+                Scheduler.check(session.get('interval_type'), session.get('interval'))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
 
-        s = board.new_session(sensor.model, session['description'],
+        s = await board.new_session(sensor.model, session['description'],
             stype=session['type'],
             interval_type=session['interval_type'],
             interval=session['interval'],
             start_date=session['start_date'],
             finish_date=session['finish_date'],
-            alert=session['alert'],
+            alert=session['alert'] or bool(rules),
             min_value=session['min_value'],
-            max_value=session['max_value']
+            max_value=session['max_value'],
+            rules=rules
         )
 
         if not session['start_date']:
-            url = "http://localhost:8000/data" if s.description == 'interval' else None
-            s.start(url)
+            await s.start()
             if s.description == 'onchange':
-                board.on_change(True)
-        else:
-            s.save_session()
+                await board.on_change(True)
 
     def put(self):
         pass
@@ -627,78 +3900,217 @@ class Sessions(RequestHandler):
 class DataSession(RequestHandler):
 
     def initialize(self):
-        self.board_id = self.get_argument('board', None)
         self.session_id = self.get_argument('session', None)
 
 
-    def get(self, action):
-        board = BOARDS[self.board_id]
-        #sensor = board.sensors[sensorid]
-        session = None
-        for s in board.sessions:
-            if s.id == self.session_id:
-                session = s
+    async def get(self, action):
+        session = SESSIONS.get(self.session_id)
+        if session is None:
+            # --workers: routed by a board that isn't the session's
+            worker = session_worker(self.session_id or '')
+            if worker == WORKER or worker >= WORKERS:
+                raise HTTPError(404)
+            res = await AsyncHTTPClient().fetch(worker_url(worker) + self.request.uri,
+                request_timeout=HTTP_TIMEOUT, raise_error=False)
+            self.set_status(res.code)
+            return
+        board = BOARDS[session.board]
 
         if action == 'start':
             if session.description == 'onchange' and not board.on_change_events:
-                board.on_change(True)
+                await board.on_change(True)
 
-            url = "http://localhost:8000/data" if session.description == 'interval' else None
-            session.start(url)
+            await session.start()
 
         elif action == 'finish':
             option = self.get_argument('option', None)
-            print("hi")
-            session.finish()
+            await session.finish(clean=option == 'clear')
             if option == 'clear':
-                session_file = read_json(SESS_FIL)
-                if session.finished:
-                    session_file['finished'].pop(session.id)
-                elif session.active:
-                    session_file['active'].pop(session.id)
+                await run_io(session.storage.remove)
+
+
+class SessionData(RequestHandler):
+    """Rows of a session in [from, to), streamed in chunks as json or csv"""
+
+    async def get(self):
+        board_id = self.get_argument('board', None)
+        sensor_m = self.get_argument('sensor', None)
+        session = await SessionManager.get_session(self.get_argument('session'))
+        if not session or board_id not in (None, session['board']) \
+                or sensor_m not in (None, session['sensor']):
+            raise HTTPError(404)
+        fmt = self.get_argument('format', 'json')
+        if fmt not in ('json', 'csv'):
+            raise HTTPError(400)
+        try:
+            start = query_time(self.get_argument('from', None))
+            end = query_time(self.get_argument('to', None))
+        except ValueError:
+            raise HTTPError(400)
+
+        # buffered rows are part of the answer
+        await SessionWriter.flush()
+        chunks = session_storage(session).iter_lines(start, end)
+
+        if fmt == 'csv':
+            self.set_header('Content-Type', 'text/csv')
+            self.write(CsvStorage.header)
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write('{"board": %s, "sensor": %s, "session": %s, "data": [' % tuple(
+                json.dumps(session[k]) for k in ('board', 'sensor', 'id')))
+        sep = ''
+        try:
+            while True:
+                lines = await run_io(next, chunks, None)
+                if lines is None:
+                    break
+                if fmt == 'csv':
+                    self.write("\n".join(lines) + "\n")
                 else:
-                    session_file['inactive'].pop(session.id)
-
-                write_json(SESS_FIL, session_file)
-                board.sessions.remove(session)
-                os.remove(session.file)
+                    self.write(sep + ",".join(f'["{l[:19]}",{l[20:]}]' for l in lines))
+                    sep = ','
+                await self.flush()
+        finally:
+            chunks.close()
+        if fmt == 'json':
+            self.write(']}')
+
+
+class SessionSummary(RequestHandler):
+    """Per minute, hour or day statistics of a session from its rollup"""
+
+    async def get(self):
+        session = await SessionManager.get_session(self.get_argument('session'))
+        if not session:
+            args = {k: self.get_argument(k) for k in self.request.arguments}
+            for r in await fan_out('/session/summary', args):
+                self.write(json.dumps(r))
+                return
+            raise HTTPError(404)
+        level = self.get_argument('level', 'hour')
+        if level not in Rollup.LEVELS:
+            raise HTTPError(400)
+        try:
+            start = query_time(self.get_argument('from', None))
+            end = query_time(self.get_argument('to', None))
+        except ValueError:
+            raise HTTPError(400)
+
+        rollup = Rollup.get(session['id'])
+        if rollup is None:
+            rollup = await run_io(Rollup.load, session['id'], f"{session['file']}.rollup.json")
+        self.write(json.dumps({
+            "board": session['board'],
+            "sensor": session['sensor'],
+            "session": session['id'],
+            "level": level,
+            "totals": rollup.totals(),
+            "buckets": rollup.summary(level, start, end)
+        }))
 
 
 class SafeStop(RequestHandler):
     
-    def get(self):
+    async def get(self):
         # check boards
         # save config  
         # save boards 
         # stop websocket
         opt = self.get_argument('opt', None)
+        # --workers: the other workers stop first, the data is removed once
+        await fan_out('/server/stop')
+        await Ingest.stop()
+        await WAL.stop()
+        await SessionWriter.stop()
+        await Rollup.save_dirty()
+        await SessionManager.stop()
+        State.save()
         if opt == 'clean':
-            rmtree(DATA_DIR)
-            if CronTab.jobs_exist():
-                CronTab.clear_jobs()
-
-        log(LOG_FILE, "alert", "Server stopped", telegram=True)
-        sleep(0.5)
+            await run_io(rmtree, DATA_DIR)
+            if await run_io(CronTab.jobs_exist):
+                await run_io(CronTab.clear_jobs)
+
+        log("alert", "Server stopped", telegram=True)
+        await run_io(Logs.stop)
+        self.finish()
+        await gen.sleep(0.5)
         IOLoop.current().stop()
 
 
-# Cambiar
+# Interval sessions are polled by the Scheduler, this only serves cron
+# entries installed by older versions
 class GetData(RequestHandler):
 
-    def get(self):
+    async def get(self):
 
         board_name = self.get_argument("board")
         sensor_name = self.get_argument("sensor")
         session_id = self.get_argument("session")
 
-        board = BOARDS[board_name]
-        sensor = board.sensors[sensor_name]
-        session = sensor.interval_sessions[session_id]
+        board = BOARDS.get(board_name)
+        sensor = board and board.sensors.get(sensor_name)
+        session = sensor and sensor.interval_sessions.get(session_id)
+        if session is None:
+            raise HTTPError(404)
 
-        value = board.get_data(sensor_name)
+        # an unreachable board is not a sample, as in Scheduler._poll
+        try:
+            value = await board.get_data(sensor_name)
+        except HTTPClientError as e:
+            raise HTTPError(504 if e.code == 599 else 502)  # 599: timed out
+        except Exception:
+            raise HTTPError(502)
+        if value is None:
+            raise HTTPError(502)
         session.write(value)
 
 
+class LogQuery(RequestHandler):
+    """Log records, oldest first, /logs?from=&to=&type=&board=&limit=&cursor=
+    where type may be repeated. Answers {"logs": [...], "next": cursor},
+    next is null on the last page. With --workers a board's records are
+    read on its worker, otherwise on ?worker=N (0)."""
+
+    async def get(self):
+        board = self.get_argument('board', None)
+        try:
+            start = query_time(self.get_argument('from', None))
+            end = query_time(self.get_argument('to', None))
+            limit = min(int(self.get_argument('limit', LOG_PAGE)), LOG_PAGE_MAX)
+            worker = owner(board) if board else int(self.get_argument('worker', 0))
+            cursor = self.get_argument('cursor', None)
+            if cursor:
+                int(cursor.rsplit('.', 1)[1])
+        except (ValueError, IndexError):
+            raise HTTPError(400)
+        if limit < 1 or not 0 <= worker < WORKERS:
+            raise HTTPError(400)
+
+        if worker != WORKER:
+            res = await AsyncHTTPClient().fetch(worker_url(worker) + self.request.uri,
+                request_timeout=HTTP_TIMEOUT, raise_error=False)
+            self.set_status(res.code)
+            self.write(res.body)
+            return
+        records, cursor = await run_io(Logs.query, start, end,
+            self.get_arguments('type'), board, cursor, limit)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({"logs": records, "next": cursor}))
+
+
+class Metrics(RequestHandler):
+    """Prometheus text format; format=json gives this process' samples,
+    used by worker 0 to merge the other workers"""
+
+    async def get(self):
+        if self.get_argument('format', None) == 'json':
+            self.write(json.dumps(metrics_lines()))
+            return
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(render_metrics(await fan_out('/metrics', {"format": "json"})))
+
+
 class TelegramConfig(RequestHandler):
 
     def get(self):
@@ -718,97 +4130,236 @@ class TelegramConfig(RequestHandler):
 
 # pendiente
 class WebsocketClientHandler(WebSocketHandler):
+    """Dashboard connection. Subscribes to every value on open, then the
+    client can narrow it down with
+    {"action": "subscribe" | "unsubscribe", "topics": ["board/sensor", "board/*", "*"],
+     "policy": {"rate": frames/s, "agg": "all" | "last" | "minmax" | "lttb", "points": n}}
+    where policy is optional and only read on subscribe."""
     
     def check_origin(self, origin):
         return True
 
-    def open(self):
-        global CLNT_WS
-        CLNT_WS = self
+    async def open(self):
+        self.channels = set()
+        self.queue = deque(maxlen=CLIENT_QUEUE)
+        self.dropped = 0
+        self._sending = False
+        Hub.join(self)
+        Hub.subscribe(self, ["*"])
         self.client_ip = self.request.remote_ip
-        log(LOG_FILE, 'alert', f'Client IP {self.client_ip} connected', telegram=True)
+        log('alert', f'Client IP {self.client_ip} connected', telegram=True)
         
         open_response = {
             "type": "open",
             "host": HOSTNAME,
             "devices": [],
+            "sessions": Rollup.live_totals(),
             "version": get_version(),
         }
         for b in BOARDS.values():
             open_response['devices'].append(b.as_dict())
+        for r in await fan_out('/'):
+            open_response['devices'].extend(r['devices'])
+            open_response['sessions'].update(r['sessions'])
         
         self.write_message(open_response)
 
+    def on_message(self, message):
+        try:
+            msg = json.loads(message)
+            action = msg['action']
+            topics = [str(t) for t in msg['topics']]
+            policy = Channel.parse_policy(msg.get('policy'))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        if action == 'subscribe':
+            Hub.subscribe(self, topics, policy)
+        elif action == 'unsubscribe':
+            Hub.unsubscribe(self, topics)
+
     def on_close(self):
-        global CLNT_WS
-        CLNT_WS = None
-        log(LOG_FILE, 'alert', f'Client IP {self.client_ip} disconnected', telegram=True)
+        Hub.leave(self)
+        log('alert', f'Client IP {self.client_ip} disconnected', telegram=True)
+
+    def send(self, frame: str) -> None:
+        """Queue an encoded frame, dropping the oldest one if full"""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(frame)
+        if not self._sending:
+            self._sending = True
+            IOLoop.current().spawn_callback(self._pump)
+
+    async def _pump(self) -> None:
+        try:
+            while self.queue:
+                await self.write_message(self.queue.popleft())
+        except WebSocketClosedError:
+            self.queue.clear()
+        finally:
+            self._sending = False
+
+
+class RelayHandler(WebSocketHandler):
+    """Worker 0 end of a Relay, live values of another worker's boards"""
 
-    def send_to_client(self, data):
-        self.write_message(data)
+    def on_message(self, message):
+        for board, sensor, points in json.loads(message):
+            Hub.publish_many(board, sensor, points)
 
 
 # Board Handlers
 
+# Binary batch frame: a base time in epoch ms (0 if the board has no clock)
+# followed by (sensor index, ms offset from base, value) samples
+BATCH_HEADER = struct.Struct('<Q')
+BATCH_SAMPLE = struct.Struct('<BHi')
+
+
 class WebsocketDataListener(WebSocketHandler):
+    """Board connection, /ws/board?id=ID&sens=s1:s2&s1=type:measure...
+    with an optional &port=N where the board serves /data (80).
+
+    Boards send "sensor:value" text frames, or with &proto=bin binary
+    batch frames (BATCH_HEADER + n * BATCH_SAMPLE). Sensor indices are the
+    position in `sens` and are sent back on open as
+    {"type": "sensors", "sensors": [...]}."""
+
+    connected = 0
 
     def check_origin(self, origin):
         return True
 
     def open(self):
+        WebsocketDataListener.connected += 1
+        self.dispatch = {}
         self.id = self.get_argument('id', default=None)
         self.device_ip = self.request.remote_ip
-        if self.id not in BOARDS.keys():
-            sens = self.get_argument('sens').split(':')
+        sens = self.get_argument('sens', default=None)
+        board = BOARDS.get(self.id)
+        if board is None:
             timestamp = time_stamp()
-            board = Board(self.id, self.device_ip, timestamp)
-            for s in sens:
+            board = Board(self.id, self.device_ip, timestamp, int(self.get_argument('port', 80)))
+            BOARDS.update({board.id: board})
+            changed = True
+        else:
+            # a restored board may come back with another address or sensors
+            port = int(self.get_argument('port', urlsplit(board.url).port or 80))
+            changed = board.url != f"http://{self.device_ip}:{port}/data"
+            if changed:
+                board.set_address(self.device_ip, port)
+        for s in sens.split(':') if sens else ():
+            if s not in board.sensors:
                 t = self.get_argument(s).split(':')
                 board.new_sensor(s, t[0], t[1])
-
-            BOARDS.update({board.id: board})
-            board.save_board()
-
-        log(LOG_FILE, "alert", f"Device {self.id} IP {self.device_ip} is Connected", telegram=True)
+                changed = True
+        if changed:
+            run_io(board.save_board)
+
+        self.bind(BOARDS[self.id], sens.split(':') if sens else None)
+        self.bad_frames = 0
+        if self.get_argument('proto', default='text') == 'bin':
+            self.write_message({"type": "sensors", "sensors": self.sensors})
+
+        log("alert", f"Device {self.id} IP {self.device_ip} is Connected", telegram=True, board=self.id)
+
+    def bind(self, board, sensors=None) -> None:
+        """Resolves the board's sensors once per connection: `sensors` is
+        the index order of binary frames and `dispatch` maps a text frame's
+        sensor name to the callable queueing its value"""
+        self.sensors = sensors or list(board.sensors)
+        self.dispatch = {sen: self._dispatcher(sen) for sen in self.sensors if sen in board.sensors}
+
+    def _dispatcher(self, sen: str):
+        labels = (self.id, sen)
+        board_id = self.id
+        # open and on_message run on the IOLoop thread, so is its shard
+        counts = BOARD_MESSAGES._shard()
+        put = Ingest.put
+
+        def dispatch(value: int):
+            counts[labels] = counts.get(labels, 0) + 1
+            return put(board_id, ((sen, ((time(), value),)),))
+        return dispatch
 
     def on_message(self, message):
-        global CLNT_WS
-        print(message)
-        data = message.split(':')
-        sen = data[0]
-        ivalue = int(data[1])
-        board = BOARDS[self.id]
-        sensor = board.sensors[sen]
-        if sensor.onchange_session:
-            sensor.onchange_session.write(ivalue)
-
-        if CLNT_WS:
-            CLNT_WS.send_to_client({
-                "type": "value",
-                "board": board.id,
-                "sensor": sen,
-                "value": ivalue
-            })
+        t0 = perf_counter()
+        if isinstance(message, bytes):
+            res = self.on_batch(message)
+        else:
+            if TRACE:
+                log("message", message, board=self.id, level=logging.DEBUG)
+            res = self.on_text(message)
+        ON_MESSAGE.observe(perf_counter() - t0)
+        return res
+
+    def on_text(self, message: str):
+        """"sensor:value" frame, anything else is counted and dropped"""
+        sen, _, raw = message.partition(':')
+        dispatch = self.dispatch.get(sen)
+        if dispatch is not None and (raw.isdecimal() or raw[:1] == '-' and raw[1:].isdecimal()):
+            value = int(raw)
+            if VALUE_MIN <= value <= VALUE_MAX:
+                return dispatch(value)
+        self.bad_frames += 1
+        BAD_FRAMES.inc((self.id,))
+        return None
+
+    def on_batch(self, frame: bytes):
+        """Decodes a binary batch and queues each sensor's samples in one go"""
+        size = len(frame) - BATCH_HEADER.size
+        if size <= 0 or size % BATCH_SAMPLE.size:
+            self.bad_frames += 1
+            BAD_FRAMES.inc((self.id,))
+            return None
+        base, = BATCH_HEADER.unpack_from(frame)
+        # values are int32 by BATCH_SAMPLE, always within VALUE_MIN..VALUE_MAX
+        samples = BATCH_SAMPLE.iter_unpack(memoryview(frame)[BATCH_HEADER.size:])
+        series = {}
+        for idx, offset, value in samples:
+            points = series.get(idx)
+            if points is None:
+                points = series[idx] = []
+            points.append((offset, value))
+        if max(series) >= len(self.sensors):
+            self.bad_frames += 1
+            BAD_FRAMES.inc((self.id,))
+            return None
+        if not base:
+            # no device clock, the newest sample is taken as received now
+            base = int(time() * 1000) - max(o for p in series.values() for o, _ in p)
+
+        sensors = self.sensors
+        for idx, points in series.items():
+            BOARD_MESSAGES.inc((self.id, sensors[idx]), len(points))
+        return Ingest.put(self.id, [
+            (sensors[idx], [((base + offset) / 1000, value) for offset, value in points])
+            for idx, points in series.items()])
 
     def on_close(self):
-        log(LOG_FILE, "alert", f"Device {self.id} is Disconnected", telegram=True)
-        print("Client Disconnected")
+        WebsocketDataListener.connected -= 1
+        log("alert", f"Device {self.id} is Disconnected", telegram=True, board=self.id)
 
     def check_status(self):
         try:
             self.ping()
-        except Exception:
-            print('ex')
+        except Exception as e:
+            log("error", f"Device {self.id} ping failed: {e}", board=self.id)
 
 
 URLS = [
     (r"/", MainHandler),
     (r"/data", GetData),
+    (r"/metrics", Metrics),
+    (r"/logs", LogQuery),
     (r"/config/telegram", TelegramConfig),
     (r"/server/stop", SafeStop),
     (r"/ws/board", WebsocketDataListener),
     (r"/ws/client", WebsocketClientHandler),
+    (r"/ws/relay", RelayHandler),
     (r"/session/action/([^/]+)", DataSession),
+    (r"/session/data", SessionData),
+    (r"/session/summary", SessionSummary),
     (r"/session", Sessions)
     ]
 
@@ -821,31 +4372,34 @@ def main():
     if not os.path.isdir(SESS_DIR):
         os.makedirs(SESS_DIR)    
 
-    if not os.path.isfile(LOG_FILE):
-        with open(LOG_FILE, 'w+') as f:
-            f.write("TimeStamp, Type, Message\n")
-        f.close()
-    if not os.path.isfile(SESS_FIL):
-        write_json(SESS_FIL, {"active":{},"inactive":{},"finished":{}})
-
-    # chequea si existe archivo con dispositivos
-    if os.path.isfile(DEV_FILE):
-        devices = read_json(DEV_FILE)   
-        for d in devices['devices']:
-            board = Board(d['id'], d['ip'], d['connection_date'])
-            board.new_sensor(
-                d['sensors']['model'],
-                d['sensors']['type'],
-                d['sensors']['measure'],
-                sid=d['sensors']['id']
-            )
-            BOARDS.update({board.id: board})
-
-    # chequea sesiones
-
+    global WORKER, DEV_FILE, SPILL_DIR, LOG_FILE, WAL_DIR
+    if WORKERS > 1:
+        WORKER, channel = fork_workers(WORKERS)
+        DEV_FILE = f"{DATA_DIR}/devices.w{WORKER}.json"
+        State._file = f"{DATA_DIR}/state.w{WORKER}.json"
+        State._log_file = f"{DATA_DIR}/state.w{WORKER}.log"
+        LOG_FILE = f"{DATA_DIR}/logs.w{WORKER}.csv"
+        SPILL_DIR = f"{SPILL_DIR}/w{WORKER}"
+        WAL_DIR = f"{WAL_DIR}/w{WORKER}"
+        SessionManager._sessions_file = f"{SESS_DIR}/sessions.w{WORKER}.json"
+        SessionManager._archive_file = f"{SESS_DIR}/archive.w{WORKER}.jsonl"
+    Logs.start()
+    t0 = perf_counter()
+    snapshot = State.load()
+    SessionManager.load_sessions(snapshot)
+    if WAL_ENABLED:
+        WAL.replay()
+    State.restore(snapshot)
+    log("alert", f"State restored in {(perf_counter() - t0) * 1000:.1f} ms, "
+        f"{len(BOARDS)} boards, {len(SESSIONS)} sessions")
+
+    # interval sessions of older versions polled through a /data cron entry,
+    # the Scheduler polls them now
+    if not WORKER and CronTab.job_exist(COMMAND):
+        CronTab.remove_job(COMMAND)
 
     #"auto update" cada lunes a las 00:01
-    if not DEBUG and not CronTab.job_exist(f"{BASE_DIR}/tc_cli.py update"):
+    if not DEBUG and not WORKER and not CronTab.job_exist(f"{BASE_DIR}/tc_cli.py update"):
         job = CronTab.new_job(f"{BASE_DIR}/tc_cli.py update")
         job.day_of_week = 1
         job.minute = 1
@@ -853,9 +4407,22 @@ def main():
 
     # Inicio del servidor
     app = Application(URLS)
-    server = HTTPServer(app)
-    server.listen(8000)
-    log(LOG_FILE, "alert", "Server started", telegram=True)
+    if WORKERS > 1:
+        server = HTTPServer(app)
+        server.add_sockets(bind_sockets(INTERNAL_PORT + WORKER, '127.0.0.1'))
+        accept_handoff(app, channel)
+        if WORKER:
+            Relay.start()
+    else:
+        server = HTTPServer(app)
+        server.listen(PORT)
+    SessionWriter.start()
+    WAL.start()
+    Rollup.start()
+    Ingest.start()
+    Alerts.start()
+    Rules.start()
+    log("alert", "Server started", telegram=True)
     IOLoop.current().start()
 
 